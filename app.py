@@ -1,40 +1,396 @@
 import os
 import sys
+import math
+import json
+import base64
+import time
 import datetime
+from functools import wraps
 from pytz import utc
-from flask import Flask, jsonify, request
+from flask import Flask, Response, request
 from flask_cors import CORS
+from sqlalchemy.exc import DBAPIError
 from werkzeug.exceptions import (
+    BadRequest,
     NotFound,
     UnprocessableEntity,
-    InternalServerError
+    InternalServerError,
+    ServiceUnavailable,
+    TooManyRequests
 )
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from models import (
+    COMMENT_DEPTH_MAX,
     Article,
     Comment,
+    TableVersion,
     User,
+    db_read_from_replica,
     db_setup,
-    db_rollback
+    db_rollback,
+    db_ping,
+    db_pool_stats,
+    db_unavailable,
+    replicas
+)
+from auth import (
+    AuthError,
+    requires_auth,
+    check_permissions,
+    get_unverified_subject,
+    jwks,
+    verified_tokens
+)
+from cache import create_backend, create_response_cache
+import compression
+import metrics
+from ratelimit import create_rate_limiter, parse_rate
+from serialization import jsonify, stream_json
+
+COMMENTS_PER_PAGE = int(os.environ.get('COMMENTS_PER_PAGE', 20))
+COMMENTS_PER_PAGE_MAX = int(os.environ.get('COMMENTS_PER_PAGE_MAX', 100))
+THREAD_DEPTH = int(os.environ.get('THREAD_DEPTH', 3))
+THREAD_DEPTH_MAX = int(os.environ.get('THREAD_DEPTH_MAX', 10))
+ARTICLE_COUNTS_MAX = int(os.environ.get('ARTICLE_COUNTS_MAX', 500))
+ARTICLES_BULK_MAX = int(os.environ.get('ARTICLES_BULK_MAX', 1000))
+USERS_PER_PAGE = int(os.environ.get('USERS_PER_PAGE', 100))
+USERS_PER_PAGE_MAX = int(os.environ.get('USERS_PER_PAGE_MAX', 1000))
+PUBLIC_CACHE_MAX_AGE = int(os.environ.get('PUBLIC_CACHE_MAX_AGE', 0))
+PUBLIC_CACHE_S_MAXAGE = os.environ.get('PUBLIC_CACHE_S_MAXAGE')
+# Stream entire lists of articles, users and threads.
+STREAM_RESPONSES = bool(os.environ.get('STREAM_RESPONSES'))
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 100))
+STREAM_CACHE_BYTES = int(os.environ.get('STREAM_CACHE_BYTES', 1024 * 1024))
+DATABASE_REPLICA_URLS = [
+    url.strip()
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url.strip()
+]
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# Serve GET /metrics and GET /cache/stats, which expose traffic of routes
+# and internals of caches.
+MONITORING_ENDPOINTS = bool(os.environ.get('MONITORING_ENDPOINTS'))
+# Number of proxies in front of the app setting X-Forwarded-For, so
+# addresses of clients are found for rate limits.
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+
+# Serialized threads of articles.
+thread_cache = create_response_cache(
+    os.environ.get('RESPONSE_CACHE_URL'),
+    max_size=int(os.environ.get('RESPONSE_CACHE_SIZE', 1024)),
+    max_bytes=int(os.environ.get('RESPONSE_CACHE_BYTES', 64 * 1024 * 1024)),
+    ttl=int(os.environ.get('RESPONSE_CACHE_TTL', 3600))
 )
-from auth import AuthError, requires_auth, check_permissions
 
-COMMENTS_PER_PAGE = 20
+# Users who changed something recently, and the time until which they read
+# from the primary to see their own writes. Writes and reads of a user may
+# be served by different workers, so they share a store if there are more
+# workers.
+recent_writers = create_backend(
+    os.environ.get('REPLICA_STICKY_URL'),
+    max_size=10000,
+    ttl=math.ceil(REPLICA_STICKY_SECONDS),
+    prefix='fcomment:writer:'
+)
+
+# Budgets of writes for each user, and of all writes for each address.
+limiter = create_rate_limiter(
+    os.environ.get('RATE_LIMIT_URL'),
+    {
+        'post_comment_to_article': parse_rate(
+            os.environ.get('RATE_LIMIT_POST_COMMENT', '10/60')
+        ),
+        'post_reply': parse_rate(
+            os.environ.get('RATE_LIMIT_POST_REPLY', '20/60')
+        ),
+        'edit_comment': parse_rate(
+            os.environ.get('RATE_LIMIT_EDIT_COMMENT', '30/60')
+        )
+    },
+    parse_rate(os.environ.get('RATE_LIMIT_PER_IP', '120/60')),
+    max_size=int(os.environ.get('RATE_LIMIT_SIZE', 100000))
+)
 
 
 def get_current_utc():
     return utc.localize(datetime.datetime.utcnow())
 
 
+def get_per_page(default, maximum):
+    per_page = request.args.get('per_page', default, type=int)
+    return max(1, min(per_page, maximum))
+
+
+def get_depth():
+    depth = request.args.get('depth', THREAD_DEPTH, type=int)
+    return max(0, min(depth, THREAD_DEPTH_MAX))
+
+
+# Users embedded to comments are asked with include=users.
+def include_users():
+    return 'users' in request.args.get('include', '').split(',')
+
+
+# Replies in the compact shape of threads don't repeat article and parent,
+# which are those of the comment they are nested in.
+def compact_shape():
+    return request.args.get('shape') == 'compact'
+
+
+# Cursors are opaque to clients: a base64 encoded key of the last item of
+# the previous page. Keys of comments are (datetime, id).
+def encode_cursor(comment):
+    return encode_key([comment.datetime.isoformat(), comment.id])
+
+
+def decode_cursor(cursor):
+    try:
+        key = decode_key(cursor)
+        return datetime.datetime.fromisoformat(key[0]), int(key[1])
+    except Exception:
+        raise UnprocessableEntity(description='Invalid cursor.')
+
+
+# Keys of users are their ids.
+def encode_user_cursor(user):
+    return encode_key([user.id])
+
+
+def decode_user_cursor(cursor):
+    try:
+        return str(decode_key(cursor)[0])
+    except Exception:
+        raise UnprocessableEntity(description='Invalid cursor.')
+
+
+def encode_key(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_key(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+
+# Set a strong ETag and Cache-Control headers for public reads.
+def public_cache(response, etag):
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = PUBLIC_CACHE_MAX_AGE
+    if PUBLIC_CACHE_S_MAXAGE is not None:
+        response.cache_control.s_maxage = int(PUBLIC_CACHE_S_MAXAGE)
+    return response
+
+
+# Return 304 Not Modified if the client already has the version, in any
+# encoding.
+def not_modified(etag):
+    for tag in compression.etag_variants(etag):
+        if request.if_none_match.contains(tag):
+            response = public_cache(app.response_class(status=304), tag)
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+
+# Version of comments of an article, and of users if they are embedded.
+def thread_etag(article):
+    etag = Article.get_version(article) or 'none'
+    if include_users():
+        etag += '.' + TableVersion.get(User.__tablename__)
+    return etag
+
+
+# Pages of a thread are cached under keys with the arguments they are built
+# with, so unknown or reordered parameters share an entry. page is (after,
+# per_page, depth) of a page, or None for the entire thread. Only the key of
+# the entire thread is invalidated, but other pages of a changed article
+# are misses by the version of the article.
+def thread_cache_key(article, page=None, users=False, compact=False):
+    parts = []
+    if page is not None:
+        after, per_page, depth = page
+        if after is not None:
+            parts.append(f'after={after[0].isoformat()},{after[1]}')
+        parts.append(f'per_page={per_page}&depth={depth}')
+    if users:
+        parts.append('include=users')
+    if compact:
+        parts.append('shape=compact')
+    key = f'thread:{article}'
+    return f'{key}?{"&".join(parts)}' if parts else key
+
+
+def invalidate_thread(article):
+    thread_cache.delete(thread_cache_key(article))
+
+
+# Respond with a serialized thread of the cache. Compressed bodies are
+# cached next to it, so a version of a thread is compressed once for each
+# encoding instead of on every request.
+def cached_thread_response(key, body, etag):
+    response = public_cache(
+        app.response_class(body, mimetype='application/json'), etag
+    )
+    encoding = compression.negotiate(len(body))
+    if encoding is None:
+        return response
+    encoded_key = f'{key}#{encoding}'
+    encoded = thread_cache.get(encoded_key, etag)
+    if encoded is None:
+        encoded = compression.compress(body, encoding)
+        thread_cache.set(encoded_key, encoded, etag)
+    compression.set_encoded(response, encoded, encoding)
+    return response
+
+
+# Page comments of top_query with their replies down to depth levels below
+# them. Comments at the cut-off get the number of their replies instead.
+# It returns reply trees, a cursor of the next page and loaded comments.
+def get_thread_page(top_query, depth, per_page, after, compact=False):
+    # Fetch one more comment to know whether a next page exists.
+    top = Comment.rows(
+        Comment.keyset_query(top_query, after).limit(per_page + 1)
+    )
+    next_cursor = None
+    if len(top) > per_page:
+        top = top[:per_page]
+        next_cursor = encode_cursor(top[-1])
+    if not top:
+        return [], next_cursor, top
+
+    comments = top
+    if depth > 0:
+        comments = Comment.rows(Comment.keyset_query(
+            Comment.subtrees_query(top, depth)
+        ))
+    cutoff = top[0].depth + depth
+    reply_counts = dict.fromkeys(
+        (c.id for c in comments if c.depth == cutoff), 0
+    )
+    reply_counts.update(Comment.get_reply_counts(reply_counts.keys()))
+    trees = Comment.format_tree(comments, reply_counts, compact)
+    return trees, next_cursor, comments
+
+
+# Reply trees of an article built from chunks of top level comments, so the
+# entire thread is never loaded at once. After the trees are exhausted,
+# seen['live'] is the number of not removed comments and seen['users'] is
+# the set of their authors.
+def iter_thread(article, seen, compact=False):
+    top = Comment.iter_rows(
+        Comment.keyset_query(Comment.top_level_query(article))
+        .yield_per(STREAM_CHUNK_SIZE)
+    )
+    chunk = []
+    for comment in top:
+        chunk.append(comment)
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield from format_subtrees(chunk, seen, compact)
+            chunk = []
+    if chunk:
+        yield from format_subtrees(chunk, seen, compact)
+
+
+def format_subtrees(top, seen, compact):
+    comments = Comment.rows(
+        Comment.keyset_query(Comment.subtrees_query(top))
+    )
+    seen['live'] += sum(1 for c in comments if c.removed is False)
+    seen['users'].update(c.user for c in comments)
+    return Comment.format_tree(comments, compact=compact)
+
+
+def log_db_error(error):
+    unavailable = db_unavailable(error)
+    metrics.db_errors.inc(str(unavailable).lower())
+    app.logger.error('Database error: %r', error, exc_info=error)
+
+
+# Options of the database engine. Pools of SQLite aren't sized.
+def get_engine_options(database_url):
+    options = {
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING') != 'false',
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    }
+    if database_url.startswith('sqlite'):
+        return options
+
+    options.update(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT', 30))
+    )
+    statement_timeout = os.environ.get('DB_STATEMENT_TIMEOUT')
+    if statement_timeout:
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={int(statement_timeout)}'
+        }
+    return options
+
+
 def raise_db_error(description=''):
-    print(sys.exc_info())
+    error = sys.exc_info()[1]
+    log_db_error(error)
     db_rollback()
+    if db_unavailable(error):
+        raise ServiceUnavailable(description='Database is unavailable.')
     raise UnprocessableEntity(description=description)
 
 
 app = Flask(__name__)
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+metrics.instrument(app)
+app.after_request(compression.compress_response)
 CORS(app, resources={r'*': {'origins': os.environ['CORS_DOMAIN']}})
-db_setup(app, os.environ['DATABASE_URL'])
+db_setup(
+    app,
+    os.environ['DATABASE_URL'],
+    get_engine_options(os.environ['DATABASE_URL']),
+    {url: get_engine_options(url) for url in DATABASE_REPLICA_URLS}
+)
+replicas.retry_interval = int(os.environ.get('REPLICA_RETRY_INTERVAL', 30))
+if (
+    DATABASE_REPLICA_URLS and
+    not os.environ.get('REPLICA_STICKY_URL') and
+    int(os.environ.get('WEB_CONCURRENCY', 1)) > 1
+):
+    app.logger.warning(
+        'Workers keep recent writers by themselves without '
+        'REPLICA_STICKY_URL, so users may not read their own writes.'
+    )
+if os.environ.get('JWKS_PREWARM'):
+    jwks.warm()
+
+
+# Reads go to a replica unless the user wrote within REPLICA_STICKY_SECONDS.
+@app.before_request
+def route_reads():
+    if not replicas or request.method not in ('GET', 'HEAD'):
+        return
+    subject = get_unverified_subject()
+    if subject is not None:
+        until = recent_writers.get(subject)
+        if until is not None and float(until) > time.time():
+            return
+    db_read_from_replica()
+
+
+# Writes only succeed with a verified token, so its subject can be trusted.
+@app.after_request
+def remember_writer(response):
+    if (
+        replicas and
+        request.method not in ('GET', 'HEAD', 'OPTIONS') and
+        response.status_code < 400
+    ):
+        subject = get_unverified_subject()
+        if subject is not None:
+            recent_writers.set(
+                subject, repr(time.time() + REPLICA_STICKY_SECONDS).encode()
+            )
+    return response
 
 
 @app.route('/')
@@ -44,6 +400,75 @@ def index():
     })
 
 
+# Health for load balancers. The database is checked only if the pool has
+# room for a connection, so checks don't wait for a saturated pool.
+@app.route('/health')
+def get_health():
+    pool = db_pool_stats()
+    if pool['saturated']:
+        database = 'skipped'
+    elif db_ping():
+        database = 'ok'
+    else:
+        return jsonify({
+            'success': False,
+            'database': 'unavailable',
+            'pool': pool,
+            'replicas': replicas.stats()
+        }), 503
+
+    return jsonify({
+        'success': True,
+        'database': database,
+        'pool': pool,
+        'replicas': replicas.stats()
+    })
+
+
+metrics.register_caches({'threads': thread_cache, 'tokens': verified_tokens})
+metrics.registry.callback(
+    'fcomment_db_pool_connections',
+    'Connections of the pool of the primary by state.',
+    ('state',),
+    lambda: {
+        (state,): value for state, value in db_pool_stats().items()
+        if state in ('checked_in', 'checked_out', 'overflow')
+    }
+)
+
+
+# Monitoring endpoints are not found unless MONITORING_ENDPOINTS is set.
+def monitoring(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not MONITORING_ENDPOINTS:
+            raise NotFound(description='Monitoring endpoints are disabled.')
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+# Metrics of this process in the text format of Prometheus
+@app.route('/metrics')
+@monitoring
+def get_metrics():
+    return Response(
+        metrics.registry.render(),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
+# Statistics of caches for monitoring
+@app.route('/cache/stats')
+@monitoring
+def get_cache_stats():
+    return jsonify({
+        'success': True,
+        'thread_cache': thread_cache.stats(),
+        'rate_limits': limiter.stats()
+    })
+
+
 # Check is the token valid
 @app.route('/auth', methods=['POST'])
 @requires_auth()
@@ -55,11 +480,54 @@ def check_authority(payload):
 
 @app.route('/users')
 def get_users():
-    users = User.query.all()
-    return jsonify({
+    etag = TableVersion.get('users')
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    # Users of given ids.
+    ids = request.args.getlist('id')
+    if ids:
+        if len(ids) > USERS_PER_PAGE_MAX:
+            raise UnprocessableEntity(
+                description=f'Cannot get more than {USERS_PER_PAGE_MAX} users.'
+            )
+        return public_cache(jsonify({
+            'success': True,
+            'users': [u.format() for u in User.get_many(ids)]
+        }), etag)
+
+    # All users unless a page is asked.
+    if 'cursor' not in request.args and 'per_page' not in request.args:
+        if STREAM_RESPONSES:
+            users = User.iter_rows(User.query.yield_per(STREAM_CHUNK_SIZE))
+            return public_cache(stream_json(
+                {'success': True}, 'users', (u.format() for u in users)
+            ), etag)
+
+        users = User.rows(User.query)
+        return public_cache(jsonify({
+            'success': True,
+            'users': [u.format() for u in users]
+        }), etag)
+
+    cursor = request.args.get('cursor')
+    per_page = get_per_page(USERS_PER_PAGE, USERS_PER_PAGE_MAX)
+    # Fetch one more user to know whether a next page exists.
+    users = User.page(
+        after=decode_user_cursor(cursor) if cursor else None,
+        limit=per_page + 1
+    )
+    next_cursor = None
+    if len(users) > per_page:
+        users = users[:per_page]
+        next_cursor = encode_user_cursor(users[-1])
+
+    return public_cache(jsonify({
         'success': True,
-        'users': [u.format() for u in users]
-    })
+        'users': [u.format() for u in users],
+        'next_cursor': next_cursor
+    }), etag)
 
 
 @app.route('/users', methods=['POST'])
@@ -100,10 +568,35 @@ def update_user(payload):
 
 @app.route('/articles')
 def get_articles():
+    etag = TableVersion.get('articles')
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    if STREAM_RESPONSES:
+        articles = Article.query.yield_per(STREAM_CHUNK_SIZE)
+        return public_cache(stream_json(
+            {'success': True}, 'articles', (a.format() for a in articles)
+        ), etag)
+
     articles = Article.query.all()
-    return jsonify({
+    return public_cache(jsonify({
         'success': True,
         'articles': [a.format() for a in articles]
+    }), etag)
+
+
+@app.route('/articles/counts')
+def get_article_counts():
+    ids = request.args.getlist('id')
+    if len(ids) > ARTICLE_COUNTS_MAX:
+        raise UnprocessableEntity(description=(
+            f'Cannot count more than {ARTICLE_COUNTS_MAX} articles.'
+        ))
+
+    return jsonify({
+        'success': True,
+        'counts': Article.get_comment_counts(ids)
     })
 
 
@@ -132,6 +625,36 @@ def post_articles(payload):
         raise_db_error(description='Cannot add an article.')
 
 
+@app.route('/articles/bulk', methods=['POST'])
+@requires_auth('post:articles')
+def post_articles_bulk(payload):
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise UnprocessableEntity(
+            description='Request body should be a JSON object.'
+        )
+    ids = body.get('ids')
+    if (not isinstance(ids, list) or
+            not all(isinstance(id, str) and id for id in ids)):
+        raise UnprocessableEntity(
+            description='ids should be a list of article IDs.'
+        )
+    if len(ids) > ARTICLES_BULK_MAX:
+        raise UnprocessableEntity(
+            description=f'Cannot add more than {ARTICLES_BULK_MAX} articles.'
+        )
+
+    try:
+        created, existing = Article.insert_many(ids)
+        return jsonify({
+            'success': True,
+            'created': created,
+            'existing': existing
+        })
+    except Exception:
+        raise_db_error(description='Cannot add articles.')
+
+
 @app.route('/articles/<string:id>', methods=['DELETE'])
 @requires_auth('delete:articles')
 def delete_articles(payload, id):
@@ -140,10 +663,9 @@ def delete_articles(payload, id):
         raise NotFound(description='Cannot find a given article.')
 
     try:
-        # Remove all related comments with a given article.
-        map(lambda c: c.delete(), Comment.query.filter_by(article=id).all())
-
+        # Related comments are removed with the article.
         found.delete()
+        invalidate_thread(id)
         return jsonify({
             'success': True,
             'id': id
@@ -154,20 +676,73 @@ def delete_articles(payload, id):
 
 @app.route('/articles/<string:id>/comments')
 def get_comments_from_article(id):
-    comments_from_article = Comment.query.filter_by(article=id)
-    recursive_comments = (
-        comments_from_article.filter_by(parent=None)
-        .order_by(Comment.datetime).all()
-    )
-    return jsonify({
-        'success': True,
-        'count': comments_from_article.filter_by(removed=False).count(),
-        'comments': [c.recursive_format() for c in recursive_comments]
-    })
+    etag = thread_etag(id)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    # The entire thread unless a page is asked.
+    paged = any(p in request.args for p in ('cursor', 'per_page', 'depth'))
+    page = None
+    if paged:
+        cursor = request.args.get('cursor')
+        page = (
+            decode_cursor(cursor) if cursor else None,
+            get_per_page(COMMENTS_PER_PAGE, COMMENTS_PER_PAGE_MAX),
+            get_depth()
+        )
+    key = thread_cache_key(id, page, include_users(), compact_shape())
+    body = thread_cache.get(key, etag)
+    if body is not None:
+        return cached_thread_response(key, body, etag)
+
+    if STREAM_RESPONSES and not paged:
+        seen = {'live': 0, 'users': set()}
+        fields = {'success': True, 'count': lambda: seen['live']}
+        if include_users():
+            fields['users'] = lambda: User.get_formatted(seen['users'])
+        return public_cache(stream_json(
+            fields,
+            'comments',
+            iter_thread(id, seen, compact_shape()),
+            on_body=lambda body: thread_cache.set(key, body, etag),
+            max_body=STREAM_CACHE_BYTES
+        ), etag)
+
+    if not paged:
+        comments = Comment.rows(Comment.thread_query(id))
+        body = {
+            'success': True,
+            'count': sum(1 for c in comments if c.removed is False),
+            'comments': Comment.format_tree(
+                comments, compact=compact_shape()
+            )
+        }
+    else:
+        after, per_page, depth = page
+        trees, next_cursor, comments = get_thread_page(
+            Comment.top_level_query(id),
+            depth,
+            per_page,
+            after,
+            compact_shape()
+        )
+        body = {
+            'success': True,
+            'count': Article.get_comment_counts([id])[id],
+            'comments': trees,
+            'next_cursor': next_cursor
+        }
+    if include_users():
+        body['users'] = User.get_formatted(c.user for c in comments)
+    body = jsonify(body).get_data()
+    thread_cache.set(key, body, etag)
+    return cached_thread_response(key, body, etag)
 
 
 @app.route('/articles/<string:id>/comments', methods=['POST'])
 @requires_auth('post:comments')
+@limiter.limit
 def post_comment_to_article(payload, id):
     try:
         comment = Comment(
@@ -179,6 +754,7 @@ def post_comment_to_article(payload, id):
             removed=False
         )
         comment.insert()
+        invalidate_thread(id)
         return jsonify({
             'success': True,
             'id': comment.id
@@ -189,20 +765,30 @@ def post_comment_to_article(payload, id):
 
 @app.route('/comments')
 def get_comments():
-    page = request.args.get('page', 1, type=int)
-    comments = (
-        Comment.query.filter_by(removed=False).order_by(Comment.datetime)
-        .paginate(page=page, per_page=COMMENTS_PER_PAGE).query.all()
-    )
-    return jsonify({
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    per_page = get_per_page(COMMENTS_PER_PAGE, COMMENTS_PER_PAGE_MAX)
+
+    # Fetch one more comment to know whether a next page exists.
+    comments = Comment.feed(after=after, limit=per_page + 1)
+    next_cursor = None
+    if len(comments) > per_page:
+        comments = comments[:per_page]
+        next_cursor = encode_cursor(comments[-1])
+
+    body = {
         'success': True,
-        'comments': [c.format() for c in comments]
-    })
+        'comments': [c.format() for c in comments],
+        'next_cursor': next_cursor
+    }
+    if include_users():
+        body['users'] = User.get_formatted(c.user for c in comments)
+    return jsonify(body)
 
 
 @app.route('/comments/<int:id>')
 def get_comment(id):
-    comment = Comment.query.filter_by(id=id).one_or_none()
+    comment = Comment.get_row(id)
     if comment is None or comment.removed:
         raise NotFound(description='Cannot find having given ID.')
 
@@ -212,27 +798,68 @@ def get_comment(id):
     })
 
 
+@app.route('/comments/<int:id>/replies')
+def get_replies(id):
+    comment = Comment.get_row(id)
+    if comment is None:
+        raise NotFound(description='Cannot find having given ID.')
+
+    etag = thread_etag(comment.article)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    cursor = request.args.get('cursor')
+    trees, next_cursor, comments = get_thread_page(
+        Comment.replies_query(id),
+        get_depth(),
+        get_per_page(COMMENTS_PER_PAGE, COMMENTS_PER_PAGE_MAX),
+        decode_cursor(cursor) if cursor else None,
+        compact_shape()
+    )
+    body = {
+        'success': True,
+        'comments': trees,
+        'next_cursor': next_cursor
+    }
+    if include_users():
+        body['users'] = User.get_formatted(c.user for c in comments)
+    return public_cache(jsonify(body), etag)
+
+
 @app.route('/comments/<int:id>', methods=['POST'])
 @requires_auth('post:comments')
+@limiter.limit
 def post_reply(payload, id):
-    parent = Comment.query.filter_by(id=id).one_or_none()
+    # Lock the parent until the reply is committed, so it is not deleted
+    # meanwhile.
+    parent = (
+        Comment.query.filter_by(id=id)
+        .with_for_update(read=True).one_or_none()
+    )
     if parent is None:
         raise NotFound(description='Cannot find a comment to reply.')
     if parent.removed:
         raise UnprocessableEntity(
             description='Cannot reply to removed comment.'
         )
+    if parent.depth >= COMMENT_DEPTH_MAX:
+        raise BadRequest(
+            description=f'Replies are limited to {COMMENT_DEPTH_MAX} levels.'
+        )
 
     try:
+        article = parent.article
         comment = Comment(
             user=payload['sub'],
             removed=False,
             datetime=get_current_utc(),
             content=request.json['content'],
-            article=parent.article,
+            article=article,
             parent=id
         )
         comment.insert()
+        invalidate_thread(article)
         return jsonify({
             'success': True,
             'id': comment.id
@@ -243,6 +870,7 @@ def post_reply(payload, id):
 
 @app.route('/comments/<int:id>', methods=['PATCH'])
 @requires_auth('post:comments')
+@limiter.limit
 def edit_comment(payload, id):
     comment = Comment.query.filter_by(id=id).one_or_none()
     if comment is None:
@@ -258,8 +886,10 @@ def edit_comment(payload, id):
         }, 403)
 
     try:
+        article = comment.article
         comment.content = request.json['content']
         comment.update()
+        invalidate_thread(article)
         return jsonify({
             'success': True,
             'id': id
@@ -275,25 +905,35 @@ def delete_comment(payload, id):
     if comment is None:
         raise NotFound(description='Cannot find a comment to remove.')
 
-    if comment.removed:
-        raise UnprocessableEntity(
-            description='Cannot remove already removed comment.'
-        )
-
-    try:
+    subtree = request.args.get('subtree') == 'true'
+    if subtree:
+        # Only administrators can delete a comment with all of its replies.
         check_permissions('delete:comments', payload)
-    except AuthError:
-        if comment.user != payload['sub']:
-            raise AuthError({
-                'code': 'unauthorized',
-                'description': (
-                    'Requestor is neither an administrator nor',
-                    'author of the comment.'
-                )
-            }, 403)
+    else:
+        if comment.removed:
+            raise UnprocessableEntity(
+                description='Cannot remove already removed comment.'
+            )
+
+        try:
+            check_permissions('delete:comments', payload)
+        except AuthError:
+            if comment.user != payload['sub']:
+                raise AuthError({
+                    'code': 'unauthorized',
+                    'description': (
+                        'Requestor is neither an administrator nor',
+                        'author of the comment.'
+                    )
+                }, 403)
 
     try:
-        comment.delete()
+        article = comment.article
+        if subtree:
+            comment.delete_subtree()
+        else:
+            comment.delete()
+        invalidate_thread(article)
 
         return jsonify({
             'success': True,
@@ -303,6 +943,15 @@ def delete_comment(payload, id):
         raise_db_error(description='Cannot edit the comment.')
 
 
+@app.errorhandler(BadRequest)
+def bad_request(error):
+    return jsonify({
+      'success': False,
+      'error': error.code,
+      'message': error.description
+    }), error.code
+
+
 @app.errorhandler(NotFound)
 def not_found(error):
     return jsonify({
@@ -330,6 +979,38 @@ def internal_server_error(error):
     }), error.code
 
 
+@app.errorhandler(ServiceUnavailable)
+def service_unavailable(error):
+    return jsonify({
+      'success': False,
+      'error': error.code,
+      'message': error.description
+    }), error.code
+
+
+@app.errorhandler(TooManyRequests)
+def too_many_requests(error):
+    response = jsonify({
+      'success': False,
+      'error': error.code,
+      'message': error.description
+    })
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, error.code
+
+
+# Errors of the database not handled by endpoints.
+@app.errorhandler(DBAPIError)
+def database_error(error):
+    log_db_error(error)
+    db_rollback()
+    if db_unavailable(error):
+        return service_unavailable(
+            ServiceUnavailable(description='Database is unavailable.')
+        )
+    return internal_server_error(InternalServerError())
+
+
 @app.errorhandler(AuthError)
 def auth_error(error):
     return jsonify({
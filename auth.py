@@ -1,13 +1,27 @@
 import os
 import json
+import time
+import hashlib
+import threading
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
+from jose.exceptions import JWTError
 from urllib.request import urlopen
 
+from cache import LRUCache
+from metrics import auth_seconds, jwks_fetch_seconds
+
 AUTH0_DOMAIN = os.environ['AUTH_DOMAIN']
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.environ['AUTH_AUDIENCE']
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+)
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+JWKS_REFRESH_INTERVAL = int(os.environ.get('JWKS_REFRESH_INTERVAL', 30))
+JWKS_TIMEOUT = int(os.environ.get('JWKS_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
 
 
 # AuthError Exception
@@ -17,6 +31,91 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS Key Store
+
+# It caches RSA keys of the JWKS by kid for ttl seconds.
+# An unknown kid triggers a refresh, but refreshes are not attempted more
+# than once in min_refresh_interval seconds to prevent refresh storms.
+# If a refresh fails, previously fetched keys are served until it succeeds.
+# The url can be a file:// url to use a local JWKS file.
+class JWKSKeyStore:
+    def __init__(self, url, ttl=600, min_refresh_interval=30, timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.keys = {}
+        self.fetched_at = None
+        self.attempted_at = None
+        self.lock = threading.Lock()
+
+    def fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as jsonurl:
+            jwks = json.loads(jsonurl.read())
+        return {
+            key['kid']: {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+            for key in jwks['keys'] if 'kid' in key
+        }
+
+    def expired(self, now):
+        return self.fetched_at is None or now - self.fetched_at >= self.ttl
+
+    def refresh(self):
+        now = time.monotonic()
+        self.attempted_at = now
+        try:
+            keys = self.fetch()
+        except Exception:
+            jwks_fetch_seconds.observe(time.monotonic() - now, 'false')
+            return False
+        jwks_fetch_seconds.observe(time.monotonic() - now, 'true')
+        self.keys = keys
+        self.fetched_at = now
+        return True
+
+    # Fetch keys in advance, i.e. on startup.
+    def warm(self):
+        with self.lock:
+            return self.refresh()
+
+    def get_key(self, kid):
+        keys = self.keys
+        if kid in keys and not self.expired(time.monotonic()):
+            return keys[kid]
+
+        # Serve a stale key while another thread is refreshing.
+        if not self.lock.acquire(blocking=(kid not in keys)):
+            return keys[kid]
+        try:
+            now = time.monotonic()
+            if (kid not in self.keys or self.expired(now)) and (
+                self.attempted_at is None or
+                now - self.attempted_at >= self.min_refresh_interval
+            ):
+                self.refresh()
+            return self.keys.get(kid)
+        finally:
+            self.lock.release()
+
+
+jwks = JWKSKeyStore(
+    JWKS_URL,
+    ttl=JWKS_TTL,
+    min_refresh_interval=JWKS_REFRESH_INTERVAL,
+    timeout=JWKS_TIMEOUT
+)
+
+# Decoded payloads of verified tokens keyed by a hash of the token.
+# They are served until the token expires to skip signature verification.
+verified_tokens = LRUCache(TOKEN_CACHE_SIZE)
+
+
 # Auth Header
 
 # it should attempt to get the header from the request
@@ -48,6 +147,18 @@ def get_token_auth_header():
     return parts[1]
 
 
+# Subject of the bearer token of the request without verifying the token,
+# or None. It must not be used to authorize anything.
+def get_unverified_subject():
+    parts = request.headers.get('Authorization', '').split()
+    if len(parts) != 2 or parts[0].lower() != 'bearer':
+        return None
+    try:
+        return jwt.get_unverified_claims(parts[1]).get('sub')
+    except JWTError:
+        return None
+
+
 # @INPUTS
 #   permission: string permission (i.e. 'post:drink')
 #   payload: decoded jwt payload
@@ -80,32 +191,35 @@ def check_permissions(permission, payload):
 #
 # it should be an Auth0 token with key id (kid)
 # it should verify the token using Auth0 /.well-known/jwks.json
+#   keys are cached by the jwks key store
 # it should decode the payload from the token
 # it should validate the claims
+# it should serve the payload of an already verified token from the cache
+#   until the token expires
 # return the decoded payload
 #
 # !!NOTE urlopen has a common certificate error described here:
 # https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    payload = verified_tokens.get(token_hash)
+    if payload is not None:
+        if payload['exp'] >= time.time():
+            return payload
+        verified_tokens.delete(token_hash)
+        raise AuthError({
+            'code': 'token_expired',
+            'description': 'Token expired.'
+        }, 401)
+
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -115,6 +229,8 @@ def verify_decode_jwt(token):
                 audience=API_AUDIENCE,
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
+            if 'exp' in payload:
+                verified_tokens.set(token_hash, payload)
 
             return payload
 
@@ -154,7 +270,11 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            started_at = time.perf_counter()
+            try:
+                payload = verify_decode_jwt(token)
+            finally:
+                auth_seconds.observe(time.perf_counter() - started_at)
 
             check_permissions(permission, payload)
 
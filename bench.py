@@ -0,0 +1,538 @@
+# Benchmarks for hot paths of fcomment.
+#
+# Benchmarks run against BENCH_DATABASE_URL, which is an in-memory SQLite
+# database by default. Point it to a scratch PostgreSQL database to measure
+# real round trips. Every benchmark removes the rows it created.
+#
+#   python bench.py thread
+#   python bench.py feed --rows 1000000
+#   python bench.py delete
+#   python bench.py path --depths 50 100
+#   python bench.py stream --rows 10000 100000
+#   python bench.py serialize --comments 100000
+#   python bench.py rows --rows 10000
+import os
+import time
+import datetime
+import gc
+import argparse
+import tracemalloc
+from flask import Flask, current_app, json, jsonify
+from sqlalchemy import event
+
+from models import (
+    Article,
+    Comment,
+    comment_path,
+    db,
+    db_setup
+)
+import serialization
+from serialization import encode, stream_json
+
+BENCH_ARTICLE = 'bench-article'
+
+
+def create_app():
+    app = Flask(__name__)
+    db_setup(app, os.environ.get('BENCH_DATABASE_URL', 'sqlite://'))
+    return app
+
+
+# Count SQL statements sent to the database while the block runs.
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def _before_cursor_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(
+            db.engine, 'before_cursor_execute', self._before_cursor_execute
+        )
+        return self
+
+    def __exit__(self, *args):
+        event.remove(
+            db.engine, 'before_cursor_execute', self._before_cursor_execute
+        )
+
+
+# Run fn repeatedly and return the best time in milliseconds with the query
+# count of a single run.
+def measure(fn, repeat=5):
+    best = None
+    queries = 0
+    for _ in range(repeat):
+        db.session.expire_all()
+        with QueryCounter() as counter:
+            start = time.perf_counter()
+            fn()
+            elapsed = (time.perf_counter() - start) * 1000
+        queries = counter.count
+        best = elapsed if best is None else min(best, elapsed)
+    return best, queries
+
+
+def next_comment_id():
+    last = db.session.query(db.func.max(Comment.id)).scalar()
+    return (last or 0) + 1
+
+
+# Insert a synthetic thread where every comment has fanout replies until
+# the given depth is reached. Returns the number of inserted comments.
+def seed_thread(article, depth, fanout):
+    if Article.query.get(article) is None:
+        db.session.add(Article(id=article))
+        db.session.commit()
+
+    next_id = next_comment_id()
+    now = datetime.datetime(2020, 9, 1)
+    rows = []
+    level = [None]
+    for d in range(depth):
+        children = []
+        for parent in level:
+            for _ in range(fanout):
+                row = {
+                    'id': next_id,
+                    'datetime': now + datetime.timedelta(seconds=next_id),
+                    'user': None,
+                    'content': f'Comment {next_id}',
+                    'article': article,
+                    'parent': parent and parent['id'],
+                    'removed': False,
+                    'path': comment_path(next_id, parent and parent['path']),
+                    'depth': d
+                }
+                rows.append(row)
+                children.append(row)
+                next_id += 1
+        level = children
+    db.session.bulk_insert_mappings(Comment, rows)
+    db.session.commit()
+    return len(rows)
+
+
+# Insert rows flat comments to an article in chunks without ORM overhead.
+def seed_comments(article, rows, chunk=10000):
+    if Article.query.get(article) is None:
+        db.session.add(Article(id=article))
+        db.session.commit()
+
+    next_id = next_comment_id()
+    now = datetime.datetime(2020, 9, 1)
+    for start in range(0, rows, chunk):
+        db.session.execute(Comment.__table__.insert(), [{
+            'id': next_id + i,
+            'datetime': now + datetime.timedelta(seconds=i),
+            'user': None,
+            'content': f'Comment {next_id + i}',
+            'article': article,
+            'parent': None,
+            'removed': i % 10 == 0,
+            'path': comment_path(next_id + i),
+            'depth': 0
+        } for i in range(start, min(start + chunk, rows))])
+        db.session.commit()
+
+
+def clear_article(article):
+    # Foreign keys between comments are checked after the whole statement.
+    Comment.query.filter_by(article=article).delete()
+    Article.query.filter_by(id=article).delete()
+    db.session.commit()
+
+
+# The former formatter of threads, kept as the baseline: one query for
+# replies of every comment.
+def recursive_format(comment):
+    ret = comment.format()
+    replies = (
+        Comment.replies_query(comment.id)
+        .order_by(Comment.datetime).all()
+    )
+    if replies != []:
+        ret['replies'] = [recursive_format(r) for r in replies]
+    return ret
+
+
+def bench_thread(args):
+    def recursive():
+        roots = (
+            Comment.query.filter_by(article=BENCH_ARTICLE, parent=None)
+            .order_by(Comment.datetime).all()
+        )
+        return [recursive_format(c) for c in roots]
+
+    def single():
+        return Comment.format_tree(
+            Comment.thread_query(BENCH_ARTICLE).all()
+        )
+
+    print(f'{"depth":>5} {"fanout":>6} {"comments":>8} '
+          f'{"recursive":>18} {"single query":>18}')
+    for depth, fanout in args.shapes:
+        count = seed_thread(BENCH_ARTICLE, depth, fanout)
+        assert recursive() == single()
+        old_ms, old_queries = measure(recursive, args.repeat)
+        new_ms, new_queries = measure(single, args.repeat)
+        print(f'{depth:>5} {fanout:>6} {count:>8} '
+              f'{old_ms:>9.1f}ms {old_queries:>5}q '
+              f'{new_ms:>9.1f}ms {new_queries:>5}q')
+        clear_article(BENCH_ARTICLE)
+
+
+def bench_feed(args):
+    seed_comments(BENCH_ARTICLE, args.rows)
+    per_page = args.per_page
+
+    # Key of the last comment of the previous page of the deep page.
+    last = (
+        Comment.feed_query()
+        .offset((args.page - 1) * per_page - 1).first()
+    )
+    after = (last.datetime, last.id)
+
+    def offset():
+        return (
+            Comment.feed_query()
+            .offset((args.page - 1) * per_page).limit(per_page + 1).all()
+        )
+
+    assert (
+        [c.id for c in offset()] ==
+        [c.id for c in Comment.feed(after=after, limit=per_page + 1)]
+    )
+    print(f'{args.rows} rows, {per_page} comments per page')
+    for name, fn in [
+        ('keyset page 1', lambda: Comment.feed(limit=per_page + 1)),
+        (f'keyset page {args.page}',
+            lambda: Comment.feed(after=after, limit=per_page + 1)),
+        (f'offset page {args.page}', offset)
+    ]:
+        ms, queries = measure(fn, args.repeat)
+        print(f'{name:>20} {ms:>9.2f}ms {queries:>3}q')
+    clear_article(BENCH_ARTICLE)
+
+
+def bench_delete(args):
+    print(f'{"comments":>8} {"delete article":>18}')
+    for rows in args.rows:
+        seed_comments(BENCH_ARTICLE, rows)
+        article = Article.query.get(BENCH_ARTICLE)
+        with QueryCounter() as counter:
+            start = time.perf_counter()
+            article.delete()
+            ms = (time.perf_counter() - start) * 1000
+        assert Comment.query.filter_by(article=BENCH_ARTICLE).count() == 0
+        print(f'{rows:>8} {ms:>9.1f}ms {counter.count:>5}q')
+
+
+# Subtree and ancestor lookups with recursive queries, as before paths.
+def recursive_subtree(comment, depth=None):
+    subtree = (
+        db.session.query(Comment.id, db.literal(0).label('level'))
+        .filter(Comment.id == comment.id)
+        .cte('subtree', recursive=True)
+    )
+    replies = (
+        db.session.query(Comment.id, subtree.c.level + 1)
+        .filter(Comment.parent == subtree.c.id)
+    )
+    if depth is not None:
+        replies = replies.filter(subtree.c.level < depth)
+    subtree = subtree.union_all(replies)
+    return Comment.query.filter(
+        Comment.id.in_(db.session.query(subtree.c.id))
+    ).all()
+
+
+def recursive_ancestors(comment):
+    ancestors = (
+        db.session.query(Comment.id, Comment.parent)
+        .filter(Comment.id == comment.parent)
+        .cte('ancestors', recursive=True)
+    )
+    ancestors = ancestors.union_all(
+        db.session.query(Comment.id, Comment.parent)
+        .filter(Comment.id == ancestors.c.parent)
+    )
+    return Comment.query.filter(
+        Comment.id.in_(db.session.query(ancestors.c.id))
+    ).all()
+
+
+def bench_path(args):
+    print(f'{"depth":>5} {"lookup":>14} {"recursive":>18} {"path":>18}')
+    for depth in args.depths:
+        seed_thread(BENCH_ARTICLE, depth, 1)
+        top = Comment.query.filter_by(
+            article=BENCH_ARTICLE, parent=None
+        ).one()
+        middle = Comment.query.filter_by(
+            article=BENCH_ARTICLE, depth=depth // 2
+        ).one()
+        last = Comment.query.filter_by(
+            article=BENCH_ARTICLE, depth=depth - 1
+        ).one()
+
+        for name, old, new in [
+            ('subtree',
+                lambda: recursive_subtree(top),
+                lambda: Comment.subtree_query(top).all()),
+            ('10 levels',
+                lambda: recursive_subtree(middle, 10),
+                lambda: Comment.subtree_query(middle, 10).all()),
+            ('ancestors',
+                lambda: recursive_ancestors(last),
+                lambda: Comment.ancestors_query(last).all())
+        ]:
+            assert (
+                sorted(c.id for c in old()) == sorted(c.id for c in new())
+            )
+            old_ms, old_queries = measure(old, args.repeat)
+            new_ms, new_queries = measure(new, args.repeat)
+            print(f'{depth:>5} {name:>14} '
+                  f'{old_ms:>9.2f}ms {old_queries:>5}q '
+                  f'{new_ms:>9.2f}ms {new_queries:>5}q')
+        clear_article(BENCH_ARTICLE)
+
+
+def bench_stream(args):
+    def build():
+        articles = Article.query.all()
+        return jsonify({
+            'success': True,
+            'articles': [a.format() for a in articles]
+        })
+
+    def stream():
+        articles = Article.query.yield_per(args.chunk)
+        return stream_json(
+            {'success': True}, 'articles', (a.format() for a in articles)
+        )
+
+    # Peak memory allocated while the response is built and written.
+    def measure_memory(fn):
+        db.session.expire_all()
+        tracemalloc.start()
+        size = 0
+        with current_app.test_request_context():
+            for chunk in fn().iter_encoded():
+                size += len(chunk)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak, size
+
+    print(f'{"rows":>8} {"bytes":>10} {"jsonify":>12} {"streamed":>12}')
+    for rows in args.rows:
+        for start in range(0, rows, 10000):
+            db.session.execute(Article.__table__.insert(), [
+                {'id': f'bench-article-{i}', 'version': '0'}
+                for i in range(start, min(start + 10000, rows))
+            ])
+        db.session.commit()
+
+        built_peak, built_size = measure_memory(build)
+        streamed_peak, streamed_size = measure_memory(stream)
+        assert built_size == streamed_size
+        print(f'{rows:>8} {built_size:>10} '
+              f'{built_peak / 1024 / 1024:>10.1f}MB '
+              f'{streamed_peak / 1024 / 1024:>10.1f}MB')
+
+        Article.query.filter(Article.id.like('bench-article-%')).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+
+
+def bench_serialize(args):
+    now = datetime.datetime(2020, 9, 1)
+    comments = [
+        Comment(
+            id=i,
+            datetime=now + datetime.timedelta(seconds=i),
+            user='auth0|5f3e92f9fe4527006d9383bc',
+            content=f'Comment {i}',
+            article=BENCH_ARTICLE,
+            parent=i - 1 if i % 5 else None,
+            removed=False
+        )
+        for i in range(args.comments)
+    ]
+
+    # Comments as formatted before, with datetimes left to the encoder.
+    def format_flask():
+        return [{
+            'id': c.id,
+            'removed': False,
+            'user': c.user,
+            'datetime': c.datetime,
+            'content': c.content,
+            'article': c.article,
+            'parent': c.parent
+        } for c in comments]
+
+    def format_fast():
+        return [c.format() for c in comments]
+
+    def encode_flask(formatted):
+        return json.dumps(formatted, separators=(',', ':')).encode()
+
+    def encode_json(formatted):
+        orjson = serialization.orjson
+        serialization.orjson = None
+        try:
+            return encode(formatted)
+        finally:
+            serialization.orjson = orjson
+
+    modes = [
+        ('flask', format_flask, encode_flask),
+        ('json', format_fast, encode_json)
+    ]
+    if serialization.orjson is not None:
+        modes.append(('orjson', format_fast, encode))
+
+    print(f'{args.comments} comments')
+    print(f'{"mode":>8} {"format":>10} {"encode":>10} {"total":>10}')
+    expected = None
+    for name, format_comments, encode_comments in modes:
+        format_ms = encode_ms = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            formatted = format_comments()
+            middle = time.perf_counter()
+            body = encode_comments(formatted)
+            end = time.perf_counter()
+            format_ms = min(format_ms or 1e9, (middle - start) * 1000)
+            encode_ms = min(encode_ms or 1e9, (end - middle) * 1000)
+        expected = expected or body
+        assert body == expected
+        print(f'{name:>8} {format_ms:>8.1f}ms {encode_ms:>8.1f}ms '
+              f'{format_ms + encode_ms:>8.1f}ms')
+
+
+def bench_rows(args):
+    seed_thread(BENCH_ARTICLE, 1, args.rows)
+    query = Comment.thread_query(BENCH_ARTICLE)
+
+    def instances():
+        return [c.format() for c in query.all()]
+
+    def rows():
+        return [c.format() for c in Comment.rows(query)]
+
+    # Memory blocks still allocated for loaded comments, before formatting.
+    def measure_blocks(load):
+        db.session.expire_all()
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        loaded = load()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = after.compare_to(before, 'filename')
+        blocks = sum(s.count_diff for s in stats)
+        size = sum(s.size_diff for s in stats)
+        del loaded
+        return blocks, size
+
+    assert instances() == rows()
+    print(f'{args.rows} comments')
+    print(f'{"load":>10} {"time":>10} {"blocks":>10} {"bytes":>10}')
+    for name, load, fn in [
+        ('instances', query.all, instances),
+        ('rows', lambda: Comment.rows(query), rows)
+    ]:
+        ms, _ = measure(fn, args.repeat)
+        blocks, size = measure_blocks(load)
+        print(f'{name:>10} {ms:>8.1f}ms {blocks:>10} {size:>10}')
+    clear_article(BENCH_ARTICLE)
+
+
+def shape(value):
+    depth, fanout = value.split('x')
+    return int(depth), int(fanout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fcomment benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    thread = subparsers.add_parser(
+        'thread',
+        help='GET /articles/<id>/comments tree assembly'
+    )
+    thread.add_argument(
+        '--shapes', type=shape, nargs='+',
+        default=[(1, 2000), (2, 44), (3, 12), (10, 2), (50, 1)],
+        help='Thread shapes as DEPTHxFANOUT.'
+    )
+    thread.add_argument('--repeat', type=int, default=5)
+    thread.set_defaults(run=bench_thread)
+
+    feed = subparsers.add_parser(
+        'feed',
+        help='GET /comments keyset pagination'
+    )
+    feed.add_argument('--rows', type=int, default=1000000)
+    feed.add_argument('--per-page', type=int, default=20)
+    feed.add_argument('--page', type=int, default=10000)
+    feed.add_argument('--repeat', type=int, default=5)
+    feed.set_defaults(run=bench_feed)
+
+    delete = subparsers.add_parser(
+        'delete',
+        help='DELETE /articles/<id> with comments'
+    )
+    delete.add_argument(
+        '--rows', type=int, nargs='+', default=[10, 1000, 100000]
+    )
+    delete.set_defaults(run=bench_delete)
+
+    path = subparsers.add_parser(
+        'path',
+        help='Subtree and ancestor lookups on deep reply chains'
+    )
+    path.add_argument(
+        '--depths', type=int, nargs='+', default=[50, 100, 200]
+    )
+    path.add_argument('--repeat', type=int, default=5)
+    path.set_defaults(run=bench_path)
+
+    stream = subparsers.add_parser(
+        'stream',
+        help='Peak memory of GET /articles built at once or streamed'
+    )
+    stream.add_argument(
+        '--rows', type=int, nargs='+', default=[1000, 10000, 100000]
+    )
+    stream.add_argument('--chunk', type=int, default=100)
+    stream.set_defaults(run=bench_stream)
+
+    serialize = subparsers.add_parser(
+        'serialize',
+        help='Formatting and encoding comments to JSON'
+    )
+    serialize.add_argument('--comments', type=int, default=100000)
+    serialize.add_argument('--repeat', type=int, default=3)
+    serialize.set_defaults(run=bench_serialize)
+
+    rows = subparsers.add_parser(
+        'rows',
+        help='Loading comments as ORM instances or as rows'
+    )
+    rows.add_argument('--rows', type=int, default=10000)
+    rows.add_argument('--repeat', type=int, default=5)
+    rows.set_defaults(run=bench_rows)
+
+    args = parser.parse_args()
+    with create_app().app_context():
+        args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,490 @@
+# Benchmark every endpoint of app.py on the database of DATABASE_URL and
+# report latency percentiles, throughput and SQL statements per request as
+# JSON, to compare results between commits.
+#
+#   python manage.py seed --articles 50 --roots 20
+#   python bench_endpoints.py --output before.json
+#   python bench_endpoints.py --gunicorn --concurrency 16 --output after.json
+#   python bench_endpoints.py --compare before.json after.json
+#
+# Requests run through the Flask test client in this process, or through a
+# local gunicorn started with gunicorn.conf.py. Tokens are signed with a key
+# generated for the run, and the app verifies them with a local JWKS file,
+# so no Auth0 tenant is needed. Articles and users of synthetic.py are used
+# when they exist. Writes are made to them and removed at the end.
+#
+# SQL statements per request are read from GET /metrics, so they are only
+# reported for a single worker of gunicorn.
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+from jose.utils import long_to_base64
+
+AUTH_DOMAIN = 'fcomment-bench.invalid'
+AUTH_AUDIENCE = 'fcomment-bench'
+KEY_ID = 'fcomment-bench'
+PERMISSIONS = [
+    'post:articles', 'delete:articles', 'post:comments', 'delete:comments'
+]
+METRIC_LINE = re.compile(
+    r'^fcomment_request_queries_(sum|count)'
+    r'\{method="([^"]*)",route="([^"]*)"\} (\S+)$'
+)
+
+
+# Sign tokens with a new key and serve its JWKS from a file.
+class LocalIssuer:
+    def __init__(self, directory):
+        self.key = RSA.generate(2048)
+        self.private_key = self.key.export_key().decode()
+        self.jwks_path = os.path.join(directory, 'jwks.json')
+        with open(self.jwks_path, 'w') as f:
+            json.dump({'keys': [{
+                'kty': 'RSA',
+                'kid': KEY_ID,
+                'use': 'sig',
+                'n': long_to_base64(self.key.n).decode(),
+                'e': long_to_base64(self.key.e).decode()
+            }]}, f)
+
+    # Writes of benchmarks exceed rate limits, so they are disabled unless
+    # RATE_LIMITS is set. Statements are counted from GET /metrics.
+    def environ(self):
+        return {
+            'AUTH_DOMAIN': AUTH_DOMAIN,
+            'AUTH_AUDIENCE': AUTH_AUDIENCE,
+            'JWKS_URL': 'file://' + self.jwks_path,
+            'CORS_DOMAIN': os.environ.get('CORS_DOMAIN', '*'),
+            'RATE_LIMITS': os.environ.get('RATE_LIMITS', 'false'),
+            'MONITORING_ENDPOINTS': 'true'
+        }
+
+    def token(self, subject, permissions=PERMISSIONS, ttl=3600):
+        now = int(time.time())
+        return jwt.encode(
+            {
+                'sub': subject,
+                'iss': f'https://{AUTH_DOMAIN}/',
+                'aud': AUTH_AUDIENCE,
+                'iat': now,
+                'exp': now + ttl,
+                'permissions': list(permissions)
+            },
+            self.private_key,
+            algorithm='RS256',
+            headers={'kid': KEY_ID}
+        )
+
+
+class TestClient:
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, url, headers=None, body=None):
+        res = self.app.test_client().open(
+            url, method=method, headers=headers, json=body
+        )
+        return res.status_code, res.get_data()
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def request(self, method, url, headers=None, body=None):
+        headers = dict(headers or {})
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(
+            self.base_url + url, data=data, headers=headers, method=method
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=60) as res:
+                return res.status, res.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+
+# Sums and counts of SQL statements per request by method and route.
+def read_query_metrics(client):
+    status, body = client.request('GET', '/metrics')
+    totals = {}
+    for line in body.decode().splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            kind, method, route, value = match.groups()
+            totals.setdefault((method, route), {})[kind] = float(value)
+    return totals
+
+
+# Ids to request, found through the API.
+class Fixture:
+    def __init__(self, client, rng):
+        status, body = client.request('GET', '/articles')
+        articles = [a['id'] for a in json.loads(body)['articles']]
+        synthetic = [a for a in articles if a.startswith('synthetic-')]
+        self.articles = synthetic or articles
+        if not self.articles:
+            raise SystemExit('No articles. Run python manage.py seed first.')
+
+        status, body = client.request('GET', '/users?per_page=1000')
+        users = [u['id'] for u in json.loads(body)['users']]
+        self.users = [u for u in users if u.startswith('synthetic|')]
+        self.writer = self.users[0] if self.users else 'synthetic|writer'
+
+        self.comments = []
+        self.parents = []
+        for article in self.articles[:10]:
+            status, body = client.request(
+                'GET', f'/articles/{article}/comments?per_page=100&depth=0'
+            )
+            for comment in json.loads(body)['comments']:
+                # Removed comments can't be replied to.
+                if not comment['removed']:
+                    self.comments.append(comment['id'])
+                if comment['reply_count']:
+                    self.parents.append(comment['id'])
+        if not self.comments:
+            raise SystemExit('No comments. Run python manage.py seed first.')
+        self.parents = self.parents or self.comments
+        self.rng = rng
+        # Comments and articles created by write scenarios.
+        self.created = []
+        self.created_articles = []
+
+    def article(self):
+        return self.rng.choice(self.articles)
+
+    def comment(self):
+        return self.rng.choice(self.comments)
+
+    def parent(self):
+        return self.rng.choice(self.parents)
+
+
+# A scenario requests one endpoint. path and body are functions of the
+# fixture. after is called with the response body of each request.
+class Scenario:
+    def __init__(self, name, method, route, path, body=None, auth=False,
+                 after=None, requests=None):
+        self.name = name
+        self.method = method
+        self.route = route
+        self.path = path
+        self.body = body
+        self.auth = auth
+        self.after = after
+        self.requests = requests
+
+
+def remember_comment(fixture, body):
+    fixture.created.append(json.loads(body)['id'])
+
+
+def take_created(fixture):
+    id = fixture.created.pop() if fixture.created else fixture.comment()
+    return f'/comments/{id}'
+
+
+def new_article(fixture):
+    id = f'synthetic-bench-{len(fixture.created_articles)}'
+    fixture.created_articles.append(id)
+    return {'id': id}
+
+
+def created_article(fixture):
+    if not fixture.created_articles:
+        return '/articles/synthetic-bench-missing'
+    return f'/articles/{fixture.created_articles.pop()}'
+
+
+SCENARIOS = [
+    Scenario('index', 'GET', '/', lambda f: '/'),
+    Scenario('health', 'GET', '/health', lambda f: '/health'),
+    Scenario('cache stats', 'GET', '/cache/stats', lambda f: '/cache/stats'),
+    Scenario('auth', 'POST', '/auth', lambda f: '/auth', auth=True),
+    Scenario('users', 'GET', '/users', lambda f: '/users'),
+    Scenario('users page', 'GET', '/users',
+             lambda f: '/users?per_page=20'),
+    Scenario('users by id', 'GET', '/users', lambda f: '/users?' + '&'.join(
+        f'id={u}' for u in f.rng.sample(f.users, min(len(f.users), 10))
+    )),
+    Scenario('update user', 'POST', '/users', lambda f: '/users',
+             body=lambda f: {
+                 'id': f.writer, 'nickname': 'synthetic writer',
+                 'picture': 'https://example.com/synthetic/writer.png'
+             }, auth=True),
+    Scenario('articles', 'GET', '/articles', lambda f: '/articles'),
+    Scenario('article counts', 'GET', '/articles/counts',
+             lambda f: '/articles/counts?' + '&'.join(
+                 f'id={a}' for a in f.articles[:50]
+             )),
+    Scenario('post article', 'POST', '/articles', lambda f: '/articles',
+             body=new_article, auth=True, requests=20),
+    Scenario('delete article', 'DELETE', '/articles/<string:id>',
+             created_article, auth=True, requests=20),
+    Scenario('post articles bulk', 'POST', '/articles/bulk',
+             lambda f: '/articles/bulk',
+             body=lambda f: {'ids': f.articles[:20]}, auth=True),
+    Scenario('thread', 'GET', '/articles/<string:id>/comments',
+             lambda f: f'/articles/{f.article()}/comments'),
+    Scenario('thread page', 'GET', '/articles/<string:id>/comments',
+             lambda f: f'/articles/{f.article()}/comments?per_page=20'),
+    Scenario('thread with users', 'GET', '/articles/<string:id>/comments',
+             lambda f: f'/articles/{f.article()}/comments?include=users'),
+    Scenario('feed', 'GET', '/comments', lambda f: '/comments'),
+    Scenario('comment', 'GET', '/comments/<int:id>',
+             lambda f: f'/comments/{f.comment()}'),
+    Scenario('replies', 'GET', '/comments/<int:id>/replies',
+             lambda f: f'/comments/{f.parent()}/replies'),
+    Scenario('post comment', 'POST', '/articles/<string:id>/comments',
+             lambda f: f'/articles/{f.article()}/comments',
+             body=lambda f: {'content': 'Benchmark comment'}, auth=True,
+             after=remember_comment),
+    Scenario('post reply', 'POST', '/comments/<int:id>',
+             lambda f: f'/comments/{f.comment()}',
+             body=lambda f: {'content': 'Benchmark reply'}, auth=True,
+             after=remember_comment),
+    Scenario('edit comment', 'PATCH', '/comments/<int:id>',
+             lambda f: f'/comments/{f.rng.choice(f.created)}',
+             body=lambda f: {'content': 'Edited benchmark comment'},
+             auth=True),
+    # Replies are removed before their parents, since they were created
+    # after them.
+    Scenario('delete comment', 'DELETE', '/comments/<int:id>',
+             take_created, auth=True)
+]
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def run_scenario(client, fixture, scenario, requests, concurrency, headers,
+                 count_queries):
+    requests = scenario.requests or requests
+    # Paths and bodies are drawn up front, so the generator isn't shared
+    # between threads.
+    calls = [
+        (
+            scenario.path(fixture),
+            scenario.body(fixture) if scenario.body else None
+        )
+        for _ in range(requests)
+    ] if scenario.method != 'DELETE' else None
+
+    def call(index):
+        if calls is None:
+            path, body = scenario.path(fixture), None
+        else:
+            path, body = calls[index]
+        started_at = time.perf_counter()
+        status, data = client.request(
+            scenario.method, path, headers if scenario.auth else None, body
+        )
+        elapsed = time.perf_counter() - started_at
+        if status < 400 and scenario.after is not None:
+            scenario.after(fixture, data)
+        return elapsed, status
+
+    before = read_query_metrics(client) if count_queries else None
+    started_at = time.perf_counter()
+    # Deletions take created ids in order, so they aren't concurrent.
+    workers = 1 if calls is None else concurrency
+    with ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(call, range(requests)))
+    wall = time.perf_counter() - started_at
+
+    latencies = sorted(elapsed for elapsed, status in results)
+    errors = sum(1 for elapsed, status in results if status >= 400)
+    result = {
+        'method': scenario.method,
+        'route': scenario.route,
+        'requests': requests,
+        'errors': errors,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'throughput_rps': requests / wall,
+        'queries_per_request': None
+    }
+    if count_queries:
+        after = read_query_metrics(client)
+        key = (scenario.method, scenario.route)
+        old = before.get(key, {})
+        new = after.get(key, {})
+        count = new.get('count', 0) - old.get('count', 0)
+        if count:
+            result['queries_per_request'] = (
+                (new.get('sum', 0) - old.get('sum', 0)) / count
+            )
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_gunicorn(environ, port, workers):
+    from loadtest import wait_ready
+
+    server = subprocess.Popen(
+        [
+            'gunicorn', '-c', 'gunicorn.conf.py',
+            '--bind', f'127.0.0.1:{port}',
+            '--log-level', 'warning',
+            'main:app'
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, WEB_CONCURRENCY=str(workers), **environ)
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        wait_ready(base_url)
+    except RuntimeError:
+        server.terminate()
+        raise
+    return server, HTTPClient(base_url)
+
+
+def benchmark(args):
+    with tempfile.TemporaryDirectory() as directory:
+        issuer = LocalIssuer(directory)
+        server = None
+        if args.gunicorn:
+            server, client = start_gunicorn(
+                issuer.environ(), args.port, args.workers
+            )
+        else:
+            os.environ.update(issuer.environ())
+            from app import app
+            client = TestClient(app)
+
+        try:
+            fixture = Fixture(client, random.Random(args.seed))
+            headers = {
+                'Authorization': f'Bearer {issuer.token(fixture.writer)}'
+            }
+            count_queries = not args.gunicorn or args.workers == 1
+            names = set(args.scenarios or [s.name for s in SCENARIOS])
+            scenarios = {}
+            for scenario in SCENARIOS:
+                if scenario.name not in names:
+                    continue
+                # Run warm-up requests of reads only.
+                if scenario.method == 'GET':
+                    run_scenario(
+                        client, fixture, scenario, args.warmup, 1, headers,
+                        False
+                    )
+                scenarios[scenario.name] = run_scenario(
+                    client, fixture, scenario, args.requests,
+                    args.concurrency, headers, count_queries
+                )
+                print(f'{scenario.name}: done', file=sys.stderr)
+            for id in fixture.created[::-1]:
+                client.request('DELETE', f'/comments/{id}', headers)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    return {
+        'revision': git_revision(),
+        'mode': 'gunicorn' if args.gunicorn else 'client',
+        'workers': args.workers if args.gunicorn else None,
+        'concurrency': args.concurrency,
+        'requests': args.requests,
+        'articles': len(fixture.articles),
+        'scenarios': scenarios
+    }
+
+
+# Print changes of p50, p99, throughput and queries between two reports.
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(
+        f'{before.get("revision")} -> {after.get("revision")}\n'
+        f'{"scenario":>20} {"p50 ms":>18} {"p99 ms":>18} '
+        f'{"req/s":>18} {"queries":>18}'
+    )
+
+    def change(old, new, digits=1):
+        if old is None or new is None:
+            return f'{"-":>18}'
+        return f'{old:>8.{digits}f} {new:>8.{digits}f} '
+
+    for name, new in after['scenarios'].items():
+        old = before['scenarios'].get(name)
+        if old is None:
+            continue
+        print(
+            f'{name:>20} '
+            f'{change(old["p50_ms"], new["p50_ms"], 2)}'
+            f'{change(old["p99_ms"], new["p99_ms"], 2)}'
+            f'{change(old["throughput_rps"], new["throughput_rps"])}'
+            f'{change(old["queries_per_request"], new["queries_per_request"])}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark endpoints of fcomment on seeded data.'
+    )
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Requests of each scenario.')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--gunicorn', action='store_true',
+                        help='Run requests through a local gunicorn.')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', nargs='+', metavar='NAME',
+                        choices=[s.name for s in SCENARIOS])
+    parser.add_argument('--output', help='Write the report to a file.')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='Compare two reports instead.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = json.dumps(benchmark(args), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
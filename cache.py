@@ -0,0 +1,206 @@
+import threading
+from collections import OrderedDict
+
+
+# Thread-safe LRU cache holding at most max_size entries.
+# It counts hits and misses for monitoring.
+class LRUCache:
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+# In-process LRU backend bounded by number of entries and total bytes.
+class LocalBackend:
+    def __init__(self, max_size=1024, max_bytes=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            self._pop(key)
+            self.entries[key] = value
+            self.bytes += len(value)
+            while (len(self.entries) > self.max_size or
+                   self.bytes > self.max_bytes):
+                self._pop(next(iter(self.entries)))
+
+    def delete(self, key):
+        with self.lock:
+            self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _pop(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.bytes -= len(value)
+
+    def stats(self):
+        return {
+            'backend': 'local',
+            'size': len(self.entries),
+            'bytes': self.bytes
+        }
+
+
+# Backend on a store shared by workers, such as Redis.
+# client should have get(key), set(key, value, ex=seconds) and delete(key).
+class SharedBackend:
+    def __init__(self, client, prefix='fcomment:', ttl=3600):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    # Entries of shared stores are left to expire with ttl.
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {
+            'backend': 'shared'
+        }
+
+
+# Local stand-in for a shared store client. It ignores expiration.
+class DictClient:
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.entries[key] = value
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+# Cache of serialized responses. It counts hits and misses for monitoring.
+# Values are stored with a version and a value of another version is a miss,
+# so a process never serves a value outdated by writes of other processes.
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version=''):
+        value = self.backend.get(key)
+        if value is not None:
+            stamp, _, value = value.partition(b'\n')
+            if stamp != version.encode():
+                value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, version=''):
+        self.backend.set(key, version.encode() + b'\n' + value)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            **self.backend.stats(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+# url selects a backend:
+#   None or empty: in-process LRU backend
+#   memory://: shared backend on a local stand-in
+#   redis://...: shared backend on Redis, if redis package is installed
+def create_backend(url=None, max_size=1024, max_bytes=64 * 1024 * 1024,
+                   ttl=3600, prefix='fcomment:'):
+    if not url:
+        return LocalBackend(max_size, max_bytes)
+    if url.startswith('memory://'):
+        return SharedBackend(DictClient(), prefix, ttl)
+
+    import redis
+    return SharedBackend(redis.Redis.from_url(url), prefix, ttl)
+
+
+def create_response_cache(url=None, max_size=1024,
+                          max_bytes=64 * 1024 * 1024, ttl=3600):
+    return ResponseCache(create_backend(url, max_size, max_bytes, ttl))
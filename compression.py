@@ -0,0 +1,92 @@
+import os
+import gzip
+from flask import request
+
+# brotli is used if it is installed and asked by clients, and gzip
+# otherwise.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES') != 'false'
+# Smaller bodies fit in a packet or two, so compressing them saves nothing.
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+
+# Encodings in order of preference between equal qualities.
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+MIMETYPES = ('application/json', 'text/plain')
+
+
+# Encoding to compress a body of the given size with for the request, or
+# None to send it as it is. Without size, the encoding of bodies large
+# enough to compress.
+def negotiate(size=None):
+    if not COMPRESS_RESPONSES or (
+        size is not None and size < COMPRESS_MIN_SIZE
+    ):
+        return None
+    best, best_quality = None, 0
+    for encoding in ENCODINGS:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def decompress(data, encoding):
+    if encoding == 'br':
+        return brotli.decompress(data)
+    return gzip.decompress(data)
+
+
+# A compressed body is another representation, so it gets its own strong
+# ETag.
+def encoded_etag(etag, encoding):
+    return f'{etag}-{encoding}'
+
+
+# ETags of the version which the request may be answered with: the identity
+# body, and the body compressed by the negotiated encoding if it is large
+# enough. Other variants are not what the client would get.
+def etag_variants(etag):
+    encoding = negotiate()
+    if encoding is None:
+        return [etag]
+    return [etag, encoded_etag(etag, encoding)]
+
+
+# Replace the body of a response with the body compressed by encoding.
+def set_encoded(response, data, encoding):
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(encoded_etag(etag, encoding), weak)
+
+
+# Compress a response after a request if the client accepts it. Streamed
+# responses are sent as they are.
+def compress_response(response):
+    if not COMPRESS_RESPONSES or response.mimetype not in MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (
+        response.status_code != 200 or
+        response.is_streamed or
+        'Content-Encoding' in response.headers
+    ):
+        return response
+    data = response.get_data()
+    encoding = negotiate(len(data))
+    if encoding is not None:
+        set_encoded(response, compress(data, encoding), encoding)
+    return response
@@ -0,0 +1,42 @@
+# Settings of gunicorn for `gunicorn -c gunicorn.conf.py main:app`.
+#
+# WEB_WORKER_CLASS selects how a worker serves concurrent requests:
+#
+#   sync    One request at a time per worker. This is the default.
+#   gthread WEB_THREADS requests at a time per worker, on threads.
+#   gevent  WEB_WORKER_CONNECTIONS requests at a time per worker, on
+#           greenlets. It needs gevent and psycogreen packages.
+#
+# Sessions of Flask-SQLAlchemy are scoped to the current greenlet, or thread
+# without greenlet, so every request has its own session in any of them.
+# Connections are still limited by DB_POOL_SIZE and DB_MAX_OVERFLOW of each
+# worker, and requests over them wait for DB_POOL_TIMEOUT.
+import os
+
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'sync')
+# gunicorn also reads WEB_CONCURRENCY, which Heroku sets by dyno size.
+# Without it there is one worker, the default of gunicorn.
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# gunicorn runs gthread workers for sync with more than one thread.
+threads = 1
+if worker_class == 'gthread':
+    threads = int(os.environ.get('WEB_THREADS', 8))
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 1000))
+# Keep-alive connections of load balancers are reused by async workers.
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+
+# The app isn't preloaded, so it is imported after gevent patched the
+# standard library in the worker, and its locks and sockets are green.
+preload_app = False
+
+
+# psycopg2 is a C extension, so patching sockets doesn't make its queries
+# yield to other greenlets. psycogreen makes it wait for the database on the
+# event loop. It is set before the app is imported, since only connections
+# opened afterwards wait that way.
+def post_fork(server, worker):
+    if worker_class != 'gevent':
+        return
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+    server.log.info('Patched psycopg2 for gevent in worker %s', worker.pid)
@@ -0,0 +1,219 @@
+# Load test of fcomment with many concurrent connections.
+#
+# Measure a running server, for example one started by
+# `gunicorn -c gunicorn.conf.py main:app`:
+#
+#   python loadtest.py http://localhost:8000/articles/hello-world/comments
+#
+# Or start gunicorn with each worker class of gunicorn.conf.py in turn on
+# the database of DATABASE_URL, and compare them on the same path:
+#
+#   python loadtest.py --compare sync gthread gevent \
+#       --path /articles/hello-world/comments
+#
+# Every connection sends GET requests one after another, reusing the
+# connection while the server keeps it alive. The client only needs the
+# standard library.
+import os
+import sys
+import time
+import signal
+import asyncio
+import argparse
+import resource
+import subprocess
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.connects = 0
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def read_body(reader, headers):
+    if headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                return
+    length = headers.get('content-length')
+    if length is not None:
+        await reader.readexactly(int(length))
+    else:
+        await reader.read()
+
+
+# Send a request and read its response. Returns whether the connection can
+# be reused.
+async def fetch(reader, writer, host, path):
+    writer.write(
+        f'GET {path} HTTP/1.1\r\nHost: {host}\r\n'
+        'Accept-Encoding: identity\r\n\r\n'.encode()
+    )
+    await writer.drain()
+    status = await reader.readline()
+    if not status:
+        raise ConnectionError('connection closed')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+    await read_body(reader, headers)
+    if int(status.split()[1]) >= 500:
+        raise ConnectionError(status.decode().strip())
+    return headers.get('connection') != 'close'
+
+
+async def connection(url, deadline, stats):
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    writer = None
+    backoff = 0.0
+    while time.monotonic() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(
+                    parts.hostname, parts.port or 80
+                )
+                stats.connects += 1
+                backoff = 0.0
+            start = time.monotonic()
+            alive = await fetch(reader, writer, parts.netloc, path)
+            stats.latencies.append(time.monotonic() - start)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            stats.errors += 1
+            alive = False
+            # Wait before connecting again to a server refusing
+            # connections, so retries don't take the CPU of the server.
+            if writer is None:
+                backoff = min(max(backoff * 2, 0.05), 1.0)
+                await asyncio.sleep(backoff)
+        if not alive and writer is not None:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def load(url, connections, duration):
+    stats = Stats()
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[
+        connection(url, deadline, stats) for _ in range(connections)
+    ])
+    return stats
+
+
+def run(url, connections, duration):
+    stats = asyncio.run(load(url, connections, duration))
+    return {
+        'requests': len(stats.latencies),
+        'rps': len(stats.latencies) / duration,
+        'p50': stats.percentile(0.5) * 1000,
+        'p99': stats.percentile(0.99) * 1000,
+        'errors': stats.errors,
+        'connects': stats.connects
+    }
+
+
+def print_result(label, result):
+    print(
+        f'{label:>10} {result["rps"]:>10.1f} req/s '
+        f'p50 {result["p50"]:>8.1f} ms  p99 {result["p99"]:>8.1f} ms  '
+        f'{result["requests"]:>7} ok {result["errors"]:>6} errors '
+        f'{result["connects"]:>7} connects'
+    )
+
+
+# Wait until GET /health of a started server answers.
+def wait_ready(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + '/health', timeout=1)
+            return
+        except urllib.error.HTTPError:
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{base_url} did not start in {timeout} seconds')
+
+
+def compare(args):
+    base_url = f'http://127.0.0.1:{args.port}'
+    for worker_class in args.compare:
+        env = dict(os.environ, WEB_WORKER_CLASS=worker_class)
+        server = subprocess.Popen(
+            [
+                'gunicorn', '-c', 'gunicorn.conf.py',
+                '--bind', f'127.0.0.1:{args.port}',
+                '--log-level', 'warning',
+                'main:app'
+            ],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env
+        )
+        try:
+            wait_ready(base_url)
+            print_result(
+                worker_class,
+                run(base_url + args.path, args.connections, args.duration)
+            )
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+
+# Every connection needs a file descriptor on both sides.
+def raise_open_files(connections):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = connections * 2 + 64
+    if soft < wanted:
+        limit = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test fcomment with concurrent connections.'
+    )
+    parser.add_argument('url', nargs='?')
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument(
+        '--compare', nargs='+', metavar='WORKER_CLASS',
+        help='start gunicorn with each worker class and measure it'
+    )
+    parser.add_argument('--path', default='/articles')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    if not args.url and not args.compare:
+        parser.error('give a URL or --compare')
+    raise_open_files(args.connections)
+    print(
+        f'{args.connections} connections for {args.duration:g} seconds each'
+    )
+    if args.compare:
+        compare(args)
+    else:
+        print_result('server', run(args.url, args.connections, args.duration))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
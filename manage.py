@@ -1,8 +1,16 @@
+# To load .env file for local development.
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except Exception:
+    pass
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, Article
+import synthetic
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +18,45 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def repair_counts():
+    "Recompute comment counts of articles from comments."
+    Article.repair_comment_counts()
+
+
+@manager.option('--users', type=int, default=100,
+                help='Number of users.')
+@manager.option('--articles', type=int, default=20,
+                help='Number of articles.')
+@manager.option('--roots', type=float, default=10,
+                help='Mean top level comments of an article.')
+@manager.option('--fanout', type=float, default=1.0,
+                help='Mean replies of a comment.')
+@manager.option('--max-depth', dest='max_depth', type=int, default=5,
+                help='Most levels of replies.')
+@manager.option('--distribution', choices=synthetic.DISTRIBUTIONS,
+                default='geometric',
+                help='Distribution of top level comments and replies.')
+@manager.option('--skew', type=float, default=1.0,
+                help='Zipf exponent of top level comments by article.')
+@manager.option('--removed', type=float, default=0.02,
+                help='Probability that a comment having replies is removed.')
+@manager.option('--seed', type=int, default=0,
+                help='Seed of the random generator.')
+@manager.option('--clear', action='store_true',
+                help='Remove synthetic data instead.')
+def seed(users, articles, roots, fanout, max_depth, distribution, skew,
+         removed, seed, clear):
+    "Generate synthetic users, articles and comment forests."
+    if clear:
+        print(synthetic.clear())
+        return
+    print(synthetic.generate(
+        users=users, articles=articles, roots=roots, fanout=fanout,
+        max_depth=max_depth, distribution=distribution, skew=skew,
+        removed=removed, seed=seed
+    ))
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,269 @@
+import time
+import bisect
+import threading
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Metrics are kept in each process and written in the text format of
+# Prometheus. Recording one is a lookup and an addition under a lock, so
+# they are cheap enough to leave on.
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20, 50, 100)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        f'{name}="{escape(value)}"' for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+def escape(value):
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+
+def format_value(value):
+    if isinstance(value, float) and value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = (
+                self.values.get(label_values, 0) + amount
+            )
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Label values to counts of each bucket, the +Inf bucket and sum.
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (
+                    len(self.buckets) + 2
+                )
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self.lock:
+            series = [(key, list(value)) for key, value in self.series.items()]
+        names = (*self.labels, 'le')
+        for label_values, counts in series:
+            total = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                total += count
+                labels = format_labels(
+                    names, (*label_values, format_value(bound))
+                )
+                yield f'{self.name}_bucket', labels, total
+            labels = format_labels(self.labels, label_values)
+            yield f'{self.name}_sum', labels, counts[-1]
+            yield f'{self.name}_count', labels, total
+
+
+# A gauge or counter read when metrics are collected. The function returns
+# a map of label values to values.
+class Callback:
+    def __init__(self, name, help, labels, function, type='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.function = function
+        self.type = type
+
+    def samples(self):
+        for label_values, value in self.function().items():
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def callback(self, *args, **kwargs):
+        return self.register(Callback(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_seconds = registry.histogram(
+    'fcomment_request_seconds',
+    'Time to respond to a request, including streaming the body.',
+    labels=('method', 'route')
+)
+responses = registry.counter(
+    'fcomment_responses_total',
+    'Responses by status code.',
+    labels=('method', 'route', 'status')
+)
+request_queries = registry.histogram(
+    'fcomment_request_queries',
+    'SQL statements executed for a request.',
+    labels=('method', 'route'),
+    buckets=QUERY_COUNT_BUCKETS
+)
+request_query_seconds = registry.histogram(
+    'fcomment_request_query_seconds',
+    'Time spent in SQL statements for a request.',
+    labels=('method', 'route')
+)
+query_seconds = registry.histogram(
+    'fcomment_query_seconds',
+    'Time of a SQL statement.'
+)
+db_errors = registry.counter(
+    'fcomment_db_errors_total',
+    'Errors of the database by whether the database was unavailable.',
+    labels=('unavailable',)
+)
+auth_seconds = registry.histogram(
+    'fcomment_auth_seconds',
+    'Time to verify a bearer token, including the token cache.'
+)
+jwks_fetch_seconds = registry.histogram(
+    'fcomment_jwks_fetch_seconds',
+    'Time to fetch the JWKS by whether it succeeded.',
+    labels=('success',)
+)
+rate_limited = registry.counter(
+    'fcomment_rate_limited_total',
+    'Requests refused by rate limits by the bucket which was empty.',
+    labels=('endpoint', 'bucket')
+)
+
+
+# Hit and miss counts of caches having stats() of cache.py, read when
+# metrics are collected. caches maps names to the caches.
+def register_caches(caches):
+    def lookups(result):
+        return lambda: {
+            (name,): cache.stats()[result] for name, cache in caches.items()
+        }
+
+    registry.callback(
+        'fcomment_cache_hits_total', 'Hits of a cache.',
+        ('cache',), lookups('hits'), type='counter'
+    )
+    registry.callback(
+        'fcomment_cache_misses_total', 'Misses of a cache.',
+        ('cache',), lookups('misses'), type='counter'
+    )
+
+
+# Route of the request for labels. Unmatched paths share one label, so
+# scanners can't add series.
+def get_route():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def start_request():
+    g.metrics_started_at = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_query_seconds = 0.0
+
+
+def record_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+# The request context of a streamed response is torn down when its body is
+# written, so time and queries of the body are counted.
+def finish_request(error=None):
+    started_at = g.pop('metrics_started_at', None)
+    if started_at is None:
+        return
+    labels = (request.method, get_route())
+    request_seconds.observe(time.perf_counter() - started_at, *labels)
+    request_queries.observe(g.metrics_queries, *labels)
+    request_query_seconds.observe(g.metrics_query_seconds, *labels)
+    status = g.get('metrics_status', 500 if error is not None else 200)
+    responses.inc(*labels, str(status))
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    context._metrics_started_at = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.perf_counter() - context._metrics_started_at
+    query_seconds.observe(elapsed)
+    if has_request_context() and 'metrics_started_at' in g:
+        g.metrics_queries += 1
+        g.metrics_query_seconds += elapsed
+
+
+# Record requests of the app and statements of every engine. It should be
+# called before other hooks are registered, so they are timed too.
+def instrument(app):
+    app.before_request(start_request)
+    app.after_request(record_status)
+    app.teardown_request(finish_request)
+    if not event.contains(
+        Engine, 'before_cursor_execute', before_cursor_execute
+    ):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
@@ -0,0 +1,47 @@
+"""add comment indexes
+
+Revision ID: 09c209785a74
+Revises:
+Create Date: 2026-10-18 08:53:27.926957
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '09c209785a74'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def index_exists(name):
+    inspector = sa.inspect(op.get_bind())
+    return any(i['name'] == name for i in inspector.get_indexes('comments'))
+
+
+def upgrade():
+    # Tables created by db.create_all() may already have these indexes.
+    if index_exists('ix_comments_datetime_id'):
+        op.drop_index('ix_comments_datetime_id', table_name='comments')
+
+    if not index_exists('ix_comments_article_datetime'):
+        op.create_index(
+            'ix_comments_article_datetime', 'comments',
+            ['article', 'datetime', 'id']
+        )
+    if not index_exists('ix_comments_parent'):
+        op.create_index('ix_comments_parent', 'comments', ['parent'])
+    if not index_exists('ix_comments_live_datetime'):
+        op.create_index(
+            'ix_comments_live_datetime', 'comments', ['datetime', 'id'],
+            postgresql_where=sa.text('removed = false'),
+            sqlite_where=sa.text('removed = 0')
+        )
+
+
+def downgrade():
+    op.drop_index('ix_comments_live_datetime', table_name='comments')
+    op.drop_index('ix_comments_parent', table_name='comments')
+    op.drop_index('ix_comments_article_datetime', table_name='comments')
@@ -0,0 +1,55 @@
+"""add article comment count
+
+Revision ID: 5257b021a6f0
+Revises: 09c209785a74
+Create Date: 2026-10-18 08:54:53.911350
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5257b021a6f0'
+down_revision = '09c209785a74'
+branch_labels = None
+depends_on = None
+
+
+articles = sa.table(
+    'articles',
+    sa.column('id', sa.String),
+    sa.column('comment_count', sa.Integer)
+)
+comments = sa.table(
+    'comments',
+    sa.column('id', sa.Integer),
+    sa.column('article', sa.String),
+    sa.column('removed', sa.Boolean)
+)
+
+
+def column_exists(name):
+    inspector = sa.inspect(op.get_bind())
+    return any(c['name'] == name for c in inspector.get_columns('articles'))
+
+
+def upgrade():
+    # Tables created by db.create_all() may already have the column.
+    if not column_exists('comment_count'):
+        op.add_column('articles', sa.Column(
+            'comment_count', sa.Integer(), nullable=False, server_default='0'
+        ))
+
+    count = (
+        sa.select([sa.func.count(comments.c.id)])
+        .where(comments.c.article == articles.c.id)
+        .where(comments.c.removed == sa.false())
+        .as_scalar()
+    )
+    op.execute(articles.update().values(comment_count=count))
+
+
+def downgrade():
+    with op.batch_alter_table('articles') as batch_op:
+        batch_op.drop_column('comment_count')
@@ -0,0 +1,37 @@
+"""order replies index by datetime
+
+Revision ID: 57a442b7ad3d
+Revises: d7facf1986c8
+Create Date: 2026-10-18 09:07:02.391565
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '57a442b7ad3d'
+down_revision = 'd7facf1986c8'
+branch_labels = None
+depends_on = None
+
+
+def index_exists(name):
+    inspector = sa.inspect(op.get_bind())
+    return any(i['name'] == name for i in inspector.get_indexes('comments'))
+
+
+def upgrade():
+    # Tables created by db.create_all() may already have these indexes.
+    if index_exists('ix_comments_parent'):
+        op.drop_index('ix_comments_parent', table_name='comments')
+    if not index_exists('ix_comments_parent_datetime'):
+        op.create_index(
+            'ix_comments_parent_datetime', 'comments',
+            ['parent', 'datetime', 'id']
+        )
+
+
+def downgrade():
+    op.drop_index('ix_comments_parent_datetime', table_name='comments')
+    op.create_index('ix_comments_parent', 'comments', ['parent'])
@@ -0,0 +1,42 @@
+"""add version stamps
+
+Revision ID: b8109220b74a
+Revises: 5257b021a6f0
+Create Date: 2026-10-18 08:59:29.174777
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8109220b74a'
+down_revision = '5257b021a6f0'
+branch_labels = None
+depends_on = None
+
+
+def column_exists(table, name):
+    inspector = sa.inspect(op.get_bind())
+    return any(c['name'] == name for c in inspector.get_columns(table))
+
+
+def upgrade():
+    # Tables created by db.create_all() may already have the changes.
+    if 'table_versions' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            'table_versions',
+            sa.Column('name', sa.String(), nullable=False),
+            sa.Column('version', sa.String(), nullable=False),
+            sa.PrimaryKeyConstraint('name')
+        )
+    if not column_exists('articles', 'version'):
+        op.add_column('articles', sa.Column(
+            'version', sa.String(), nullable=False, server_default='0'
+        ))
+
+
+def downgrade():
+    with op.batch_alter_table('articles') as batch_op:
+        batch_op.drop_column('version')
+    op.drop_table('table_versions')
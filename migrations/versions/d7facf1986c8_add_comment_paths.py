@@ -0,0 +1,91 @@
+"""add comment paths
+
+Revision ID: d7facf1986c8
+Revises: b8109220b74a
+Create Date: 2026-10-18 09:04:42.300695
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7facf1986c8'
+down_revision = 'b8109220b74a'
+branch_labels = None
+depends_on = None
+
+
+comments = sa.table(
+    'comments',
+    sa.column('id', sa.Integer),
+    sa.column('parent', sa.Integer),
+    sa.column('path', sa.String),
+    sa.column('depth', sa.Integer)
+)
+
+
+def column_exists(name):
+    inspector = sa.inspect(op.get_bind())
+    return any(c['name'] == name for c in inspector.get_columns('comments'))
+
+
+def index_exists(name):
+    inspector = sa.inspect(op.get_bind())
+    return any(i['name'] == name for i in inspector.get_indexes('comments'))
+
+
+# Zero-padded id, the same as models.comment_path().
+def segment(id):
+    if op.get_bind().dialect.name == 'postgresql':
+        return sa.func.lpad(sa.cast(id, sa.String), 10, '0')
+    return sa.func.printf('%010d', id)
+
+
+def upgrade():
+    # Tables created by db.create_all() may already have the changes.
+    if not column_exists('path'):
+        op.add_column('comments', sa.Column('path', sa.String()))
+    if not column_exists('depth'):
+        op.add_column('comments', sa.Column('depth', sa.Integer()))
+    if not index_exists('ix_comments_path'):
+        op.create_index(
+            'ix_comments_path', 'comments', ['path'],
+            postgresql_ops={'path': 'text_pattern_ops'}
+        )
+
+    # Fill paths level by level from top level comments.
+    bind = op.get_bind()
+    bind.execute(
+        comments.update()
+        .where(comments.c.parent.is_(None))
+        .values(path=segment(comments.c.id), depth=0)
+    )
+    parents = comments.alias('parents')
+    parent = sa.and_(
+        parents.c.id == comments.c.parent, parents.c.path.isnot(None)
+    )
+    while True:
+        result = bind.execute(
+            comments.update()
+            .where(comments.c.path.is_(None))
+            .where(sa.exists().where(parent))
+            .values(
+                path=(
+                    sa.select([parents.c.path]).where(parent).as_scalar() +
+                    '/' + segment(comments.c.id)
+                ),
+                depth=(
+                    sa.select([parents.c.depth + 1]).where(parent).as_scalar()
+                )
+            )
+        )
+        if result.rowcount == 0:
+            break
+
+
+def downgrade():
+    op.drop_index('ix_comments_path', table_name='comments')
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.drop_column('depth')
+        batch_op.drop_column('path')
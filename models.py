@@ -1,22 +1,126 @@
+import time
+import itertools
+from uuid import uuid4
+from collections import namedtuple
 from sqlalchemy import (
     Column,
     String,
     Integer,
     ForeignKey,
     DateTime,
-    Boolean
+    Boolean,
+    Index,
+    false,
+    true,
+    or_,
+    select,
+    tuple_,
+    create_engine
 )
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.pool import QueuePool
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy.orm import sessionmaker
 
-db = SQLAlchemy()
+from serialization import http_date
 
 
-def db_setup(app, database_path):
+# Engines of read replicas. They are used in turn, and a replica failing to
+# connect is left out for retry_interval seconds, so reads fail over to the
+# other replicas and then to the primary.
+class ReplicaSet:
+    def __init__(self, retry_interval=30):
+        self.engines = []
+        self.retry_interval = retry_interval
+        self.down_until = {}
+        self.turns = itertools.count()
+
+    def __bool__(self):
+        return bool(self.engines)
+
+    def available(self):
+        now = time.monotonic()
+        return [
+            engine for engine in self.engines
+            if self.down_until.get(engine, 0) <= now
+        ]
+
+    def choose(self):
+        engines = self.available()
+        if not engines:
+            return None
+        return engines[next(self.turns) % len(engines)]
+
+    def mark_down(self, engine):
+        self.down_until[engine] = time.monotonic() + self.retry_interval
+
+    def stats(self):
+        return {
+            'replicas': len(self.engines),
+            'available': len(self.available())
+        }
+
+
+replicas = ReplicaSet()
+
+
+# A session reading from a replica once it is asked to by
+# db_read_from_replica(). Flushes, and sessions without an available
+# replica, use the primary.
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('read_replica') and not self._flushing:
+            if 'replica' not in self.info:
+                self.info['replica'] = self.connect_replica()
+            if self.info['replica'] is not None:
+                return self.info['replica']
+        return super().get_bind(mapper, clause)
+
+    # The connection is taken here, so a replica that is down is skipped
+    # before any query of the request runs on it.
+    def connect_replica(self):
+        while True:
+            engine = replicas.choose()
+            if engine is None:
+                return None
+            try:
+                self.connection(bind=engine)
+                return engine
+            except DBAPIError as error:
+                if not db_unavailable(error):
+                    raise
+                replicas.mark_down(engine)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+# replica_options maps URLs of read replicas to their engine options.
+def db_setup(app, database_path, engine_options=None, replica_options=None):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options or {}
     db.app = app
     db.init_app(app)
     db.create_all()
+    replicas.engines = [
+        create_engine(url, **options)
+        for url, options in (replica_options or {}).items()
+    ]
+    replicas.down_until.clear()
+
+
+# Queries of the current session read from a replica if there is one.
+# It must be called before the first query of the session.
+def db_read_from_replica():
+    if replicas:
+        db.session.info['read_replica'] = True
 
 
 def db_rollback():
@@ -24,8 +128,45 @@ def db_rollback():
     db.session.close()
 
 
-def db_exists(query):
-    return db.session.query(query.exists()).scalar()
+# Whether an error means the database can't be used for now: a connection
+# is lost, the database is unreachable or a statement timed out.
+def db_unavailable(error):
+    return isinstance(error, DBAPIError) and (
+        error.connection_invalidated or isinstance(error, OperationalError)
+    )
+
+
+def db_ping():
+    try:
+        with db.engine.connect() as connection:
+            connection.scalar(select([1]))
+        return True
+    except DBAPIError:
+        return False
+
+
+# Statistics of the connection pool. They are read without taking a
+# connection.
+def db_pool_stats():
+    pool = db.engine.pool
+    if not isinstance(pool, QueuePool):
+        return {'class': type(pool).__name__, 'saturated': False}
+
+    max_overflow = pool._max_overflow
+    return {
+        'class': type(pool).__name__,
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+        'max_overflow': max_overflow,
+        'timeout': pool.timeout(),
+        # A negative max_overflow means no limit.
+        'saturated': (
+            max_overflow >= 0 and
+            pool.checkedout() >= pool.size() + max_overflow
+        )
+    }
 
 
 class DBInterface:
@@ -41,10 +182,171 @@ class DBInterface:
         db.session.commit()
 
 
+# Read paths load rows of a model as Row records, named tuples of its
+# columns. They skip the identity map and change tracking of ORM instances
+# and have the same format() as the model.
+class RowInterface:
+    @classmethod
+    def rows(cls, query):
+        return list(cls.iter_rows(query))
+
+    @classmethod
+    def iter_rows(cls, query):
+        columns = [getattr(cls, name) for name in cls.Row._fields]
+        return map(cls.Row._make, query.with_entities(*columns))
+
+
+def new_version():
+    return uuid4().hex
+
+
+# Deepest level of replies. Every level adds 11 bytes to path and rows of
+# a btree index of PostgreSQL are limited to about 2.7KB, so paths of
+# deeper comments couldn't be indexed.
+COMMENT_DEPTH_MAX = 200
+
+
+# Materialized path of a comment: ids from the root down to the comment,
+# zero-padded to the same width so a prefix of a path matches a subtree.
+def comment_path(id, parent_path=None):
+    segment = f'{id:010d}'
+    return segment if parent_path is None else f'{parent_path}/{segment}'
+
+
+# Version stamps of whole tables to build ETags without loading rows.
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(String, nullable=False, default=new_version)
+
+    @classmethod
+    def get(cls, name):
+        return (
+            db.session.query(cls.version).filter_by(name=name).scalar() or
+            '0'
+        )
+
+    # It should be called in the transaction changing the table. The row of
+    # a table is created by its first change. On PostgreSQL it is an upsert,
+    # so concurrent first changes don't both insert it.
+    @classmethod
+    def bump(cls, name):
+        if db.engine.dialect.name == 'postgresql':
+            statement = postgresql.insert(cls.__table__).values(
+                name=name, version=new_version()
+            )
+            db.session.execute(statement.on_conflict_do_update(
+                index_elements=[cls.__table__.c.name],
+                set_={'version': statement.excluded.version}
+            ))
+            return
+        updated = cls.query.filter_by(name=name).update(
+            {cls.version: new_version()}, synchronize_session=False
+        )
+        if updated == 0:
+            db.session.add(cls(name=name))
+
+
 class Article(db.Model, DBInterface):
     __tablename__ = 'articles'
 
     id = Column(String, primary_key=True)
+    # Number of not removed comments.
+    # It is updated in the same transaction as comments.
+    comment_count = Column(Integer, nullable=False, default=0,
+                           server_default='0')
+    # Version stamp of comments of the article.
+    # It is changed in the same transaction as comments.
+    version = Column(String, nullable=False, default=new_version,
+                     server_default='0')
+
+    def insert(self):
+        TableVersion.bump(self.__tablename__)
+        super().insert()
+
+    # Comments of the article are deleted together in one statement.
+    # Foreign keys between comments are checked after the whole statement.
+    def delete(self):
+        Comment.query.filter_by(article=self.id).delete(
+            synchronize_session=False
+        )
+        TableVersion.bump(self.__tablename__)
+        super().delete()
+
+    # Insert articles of given ids in one statement, skipping existing ones.
+    # It returns lists of created and already existing ids.
+    @classmethod
+    def insert_many(cls, ids):
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return [], []
+
+        rows = [
+            {'id': id, 'comment_count': 0, 'version': new_version()}
+            for id in ids
+        ]
+        if db.engine.dialect.name == 'postgresql':
+            statement = (
+                postgresql.insert(cls.__table__).values(rows)
+                .on_conflict_do_nothing().returning(cls.__table__.c.id)
+            )
+            created = {id for id, in db.session.execute(statement)}
+        else:
+            existing = {
+                id for id, in
+                db.session.query(cls.id).filter(cls.id.in_(ids))
+            }
+            rows = [r for r in rows if r['id'] not in existing]
+            if rows:
+                db.session.execute(cls.__table__.insert(), rows)
+            created = {r['id'] for r in rows}
+
+        if created:
+            TableVersion.bump(cls.__tablename__)
+        db.session.commit()
+        return (
+            [id for id in ids if id in created],
+            [id for id in ids if id not in created]
+        )
+
+    # Mark comments of the article changed.
+    @classmethod
+    def touch(cls, id, comment_count_delta=0):
+        cls.query.filter_by(id=id).update(
+            {
+                cls.version: new_version(),
+                cls.comment_count: cls.comment_count + comment_count_delta
+            },
+            synchronize_session=False
+        )
+
+    # Version of comments of the article, or None if it doesn't exist.
+    @classmethod
+    def get_version(cls, id):
+        return db.session.query(cls.version).filter_by(id=id).scalar()
+
+    @classmethod
+    def get_comment_counts(cls, ids):
+        counts = dict.fromkeys(ids, 0)
+        counts.update(
+            db.session.query(cls.id, cls.comment_count)
+            .filter(cls.id.in_(ids)).all()
+        )
+        return counts
+
+    # Recompute comment counts from scratch if they drift.
+    @classmethod
+    def repair_comment_counts(cls):
+        count = (
+            db.session.query(db.func.count(Comment.id))
+            .filter(Comment.article == cls.id, Comment.removed == false())
+            .correlate(cls).as_scalar()
+        )
+        cls.query.update(
+            {cls.comment_count: count}, synchronize_session=False
+        )
+        db.session.commit()
 
     def format(self):
         return {
@@ -52,42 +354,15 @@ class Article(db.Model, DBInterface):
         }
 
 
-class Comment(db.Model, DBInterface):
-    __tablename__ = 'comments'
-
-    id = Column(Integer, primary_key=True)
-    datetime = Column(DateTime)
-    user = Column(String, ForeignKey('users.id'))
-    content = Column(String)
-    article = Column(String, ForeignKey('articles.id'))
-    parent = Column(Integer, ForeignKey('comments.id'))
-    removed = Column(Boolean)
-
-    def delete(self):
-        if db_exists(Comment.query.filter_by(parent=self.id)):
-            self.removed = True
-            self.content = None
-            self.user = None
-            self.update()
-        else:
-            super().delete()
-            if self.parent is not None:
-                parent_comment = (
-                    Comment.query.filter_by(id=self.parent)
-                    .one_or_none()
-                )
-                if (parent_comment.removed and
-                    not db_exists(
-                        Comment.query
-                        .filter_by(parent=parent_comment.id))):
-                    parent_comment.delete()
+class CommentFormat:
+    __slots__ = ()
 
     def format(self):
         if self.removed:
             return {
                 'id': self.id,
                 'removed': True,
-                'datetime': self.datetime,
+                'datetime': http_date(self.datetime),
                 'article': self.article,
                 'parent': self.parent
             }
@@ -95,29 +370,255 @@ class Comment(db.Model, DBInterface):
             'id': self.id,
             'removed': False,
             'user': self.user,
-            'datetime': self.datetime,
+            'datetime': http_date(self.datetime),
             'content': self.content,
             'article': self.article,
             'parent': self.parent
         }
 
-    def recursive_format(self):
-        ret = self.format()
-        replies = (
-            Comment.query.filter_by(parent=self.id)
-            .order_by(Comment.datetime).all()
+
+class CommentRow(CommentFormat, namedtuple('CommentRow', [
+    'id', 'datetime', 'user', 'content', 'article', 'parent', 'removed',
+    'path', 'depth'
+])):
+    __slots__ = ()
+
+
+class Comment(db.Model, DBInterface, RowInterface, CommentFormat):
+    __tablename__ = 'comments'
+    Row = CommentRow
+
+    id = Column(Integer, primary_key=True)
+    datetime = Column(DateTime)
+    user = Column(String, ForeignKey('users.id'))
+    content = Column(String)
+    article = Column(String, ForeignKey('articles.id'))
+    parent = Column(Integer, ForeignKey('comments.id'))
+    removed = Column(Boolean)
+    # Set on insert and never changed. See comment_path().
+    path = Column(String)
+    # Number of ancestors, 0 for top level comments.
+    depth = Column(Integer)
+
+    __table_args__ = (
+        # Threads of an article ordered by datetime.
+        Index('ix_comments_article_datetime', 'article', 'datetime', 'id'),
+        # Replies of a comment ordered by datetime.
+        Index('ix_comments_parent_datetime', 'parent', 'datetime', 'id'),
+        # Subtrees by prefix of path.
+        Index(
+            'ix_comments_path', 'path',
+            postgresql_ops={'path': 'text_pattern_ops'}
+        ),
+        # Not removed comments ordered by datetime.
+        Index(
+            'ix_comments_live_datetime', 'datetime', 'id',
+            postgresql_where=(removed == false()),
+            sqlite_where=(removed == false())
+        ),
+    )
+
+    def insert(self):
+        Article.touch(self.article, 0 if self.removed else 1)
+        db.session.add(self)
+        # The path ends with the id given by the database.
+        db.session.flush()
+        if self.parent is None:
+            self.path = comment_path(self.id)
+            self.depth = 0
+        else:
+            # The parent is usually loaded already in the session.
+            parent = Comment.query.get(self.parent)
+            self.path = comment_path(self.id, parent.path)
+            self.depth = parent.depth + 1
+        db.session.commit()
+
+    def update(self):
+        Article.touch(self.article)
+        super().update()
+
+    # Delete the comment, or mark it removed if it has replies.
+    # Removed ancestors left without replies are deleted together.
+    # Everything runs in one transaction with the rows locked, so a reply
+    # cannot land under a comment being deleted.
+    def delete(self):
+        locked = self.lock_with_ancestors()
+        if self.id not in locked:
+            # Already deleted by another request.
+            db.session.rollback()
+            return
+
+        reply_counts = Comment.get_reply_counts(locked.keys())
+        Article.touch(self.article, 0 if self.removed else -1)
+        if reply_counts.get(self.id, 0) > 0:
+            self.removed = True
+            self.content = None
+            self.user = None
+        else:
+            ids = [self.id] + self.removed_ancestors(locked, reply_counts)
+            # Foreign keys between comments are checked after the statement.
+            Comment.query.filter(Comment.id.in_(ids)).delete(
+                synchronize_session=False
+            )
+        db.session.commit()
+
+    # Delete the comment with all of its replies in one statement.
+    # A reply posted to the subtree meanwhile fails the foreign key check
+    # and the whole deletion is rolled back.
+    def delete_subtree(self):
+        locked = self.lock_with_ancestors()
+        if self.id not in locked:
+            db.session.rollback()
+            return
+
+        count = (
+            Comment.subtree_query(self).with_entities(db.func.count())
+            .filter(Comment.removed == false()).scalar()
         )
-        if replies != []:
-            ret['replies'] = [r.recursive_format() for r in replies]
-        return ret
 
+        reply_counts = Comment.get_reply_counts(locked.keys())
+        ancestors = self.removed_ancestors(locked, reply_counts)
+        Comment.query.filter(
+            or_(Comment.path.like(f'{self.path}%'), Comment.id.in_(ancestors))
+        ).delete(synchronize_session=False)
+        Article.touch(self.article, -count)
+        db.session.commit()
 
-class User(db.Model, DBInterface):
-    __tablename__ = 'users'
+    # Lock the comment, its parent and removed ancestors, which are the
+    # comments a deletion may change.
+    # Rows are locked in order of id to avoid deadlocks.
+    def lock_with_ancestors(self):
+        comments = (
+            Comment.query.filter(
+                Comment.id.in_([self.id] + self.ancestor_ids()),
+                or_(Comment.id.in_([self.id, self.parent]),
+                    Comment.removed == true())
+            )
+            .order_by(Comment.id)
+            .with_for_update(of=Comment)
+            .populate_existing()
+            .all()
+        )
+        return {c.id: c for c in comments}
+
+    @classmethod
+    def get_reply_counts(cls, ids):
+        return dict(
+            db.session.query(cls.parent, db.func.count(cls.id))
+            .filter(cls.parent.in_(ids))
+            .group_by(cls.parent).all()
+        )
+
+    # Ids of removed ancestors which have no other replies than the chain
+    # from the comment, so they are deleted with the comment.
+    def removed_ancestors(self, locked, reply_counts):
+        ids = []
+        ancestor = locked.get(self.parent)
+        while (ancestor is not None and ancestor.removed and
+               reply_counts.get(ancestor.id, 0) <= 1):
+            ids.append(ancestor.id)
+            ancestor = locked.get(ancestor.parent)
+        return ids
+
+    # Queries for hot paths. They should match indexes in __table_args__.
+    @classmethod
+    def thread_query(cls, article):
+        return (
+            cls.query.filter_by(article=article)
+            .order_by(cls.datetime, cls.id)
+        )
+
+    @classmethod
+    def replies_query(cls, id):
+        return cls.query.filter_by(parent=id)
+
+    @classmethod
+    def top_level_query(cls, article):
+        return cls.query.filter_by(article=article, parent=None)
+
+    # The comment with its replies down to depth levels below it, or all of
+    # them if depth is None.
+    @classmethod
+    def subtree_query(cls, comment, depth=None):
+        query = cls.query.filter(cls.path.like(f'{comment.path}%'))
+        if depth is not None:
+            query = query.filter(cls.depth <= comment.depth + depth)
+        return query
+
+    # Subtrees of comments on the same level, down to depth levels below
+    # them or entirely if depth is None, in one query.
+    @classmethod
+    def subtrees_query(cls, comments, depth=None):
+        query = cls.query.filter(
+            or_(*(cls.path.like(f'{c.path}%') for c in comments))
+        )
+        if depth is not None:
+            query = query.filter(cls.depth <= comments[0].depth + depth)
+        return query
+
+    # Ancestors of the comment from the top level comment.
+    @classmethod
+    def ancestors_query(cls, comment):
+        return (
+            cls.query.filter(cls.id.in_(comment.ancestor_ids()))
+            .order_by(cls.depth)
+        )
+
+    def ancestor_ids(self):
+        return [int(id) for id in self.path.split('/')[:-1]]
+
+    # Order comments of the query by datetime and id.
+    # after is a (datetime, id) key of the last comment of the previous page.
+    @classmethod
+    def keyset_query(cls, query, after=None):
+        if after is not None:
+            query = query.filter(tuple_(cls.datetime, cls.id) > tuple_(*after))
+        return query.order_by(cls.datetime, cls.id)
+
+    # Get not removed comments ordered by datetime and id.
+    @classmethod
+    def feed_query(cls, after=None):
+        return cls.keyset_query(
+            cls.query.filter(cls.removed == false()), after
+        )
+
+    @classmethod
+    def feed(cls, after=None, limit=20):
+        return cls.rows(cls.feed_query(after).limit(limit))
+
+    @classmethod
+    def get_row(cls, id):
+        rows = cls.rows(cls.query.filter_by(id=id))
+        return rows[0] if rows else None
+
+    # Build reply trees from comments already ordered by datetime,
+    # so an entire thread needs only a single query.
+    # Comments whose parent is not given are roots of the trees.
+    # Comments in reply_counts are cut off from their replies, and get the
+    # number of them instead. With compact, replies leave out article and
+    # parent, which are those of the comment they are nested in.
+    @staticmethod
+    def format_tree(comments, reply_counts=None, compact=False):
+        formatted = {}
+        roots = []
+        for c in comments:
+            formatted[c.id] = c.format()
+        for c in comments:
+            if c.parent in formatted:
+                reply = formatted[c.id]
+                if compact:
+                    del reply['article'], reply['parent']
+                formatted[c.parent].setdefault('replies', []).append(reply)
+            else:
+                roots.append(formatted[c.id])
+        for id, count in (reply_counts or {}).items():
+            formatted[id]['reply_count'] = count
+            formatted[id]['has_more_replies'] = count > 0
+        return roots
 
-    id = Column(String, primary_key=True)
-    nickname = Column(String)
-    picture = Column(String)
+
+class UserFormat:
+    __slots__ = ()
 
     def format(self):
         return {
@@ -125,3 +626,50 @@ class User(db.Model, DBInterface):
             'nickname': self.nickname,
             'picture': self.picture
         }
+
+
+class UserRow(UserFormat, namedtuple('UserRow', [
+    'id', 'nickname', 'picture'
+])):
+    __slots__ = ()
+
+
+class User(db.Model, DBInterface, RowInterface, UserFormat):
+    __tablename__ = 'users'
+    Row = UserRow
+
+    id = Column(String, primary_key=True)
+    nickname = Column(String)
+    picture = Column(String)
+
+    def insert(self):
+        TableVersion.bump(self.__tablename__)
+        super().insert()
+
+    def update(self):
+        TableVersion.bump(self.__tablename__)
+        super().update()
+
+    @classmethod
+    def get_many(cls, ids):
+        return cls.rows(
+            cls.query.filter(cls.id.in_(set(ids))).order_by(cls.id)
+        )
+
+    # Formatted users of given ids by id, loaded in one query.
+    # Ids can be repeated and None is ignored.
+    @classmethod
+    def get_formatted(cls, ids):
+        ids = {id for id in ids if id is not None}
+        if not ids:
+            return {}
+        return {u.id: u.format() for u in cls.get_many(ids)}
+
+    # Get users ordered by id after the id of the last user of the previous
+    # page.
+    @classmethod
+    def page(cls, after=None, limit=100):
+        query = cls.query
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return cls.rows(query.order_by(cls.id).limit(limit))
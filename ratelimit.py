@@ -0,0 +1,192 @@
+import os
+import math
+import time
+import threading
+from functools import wraps
+from collections import OrderedDict
+from flask import request
+from werkzeug.exceptions import TooManyRequests
+
+from cache import DictClient
+from metrics import rate_limited
+
+# Writes are limited by token buckets of the user and the client address.
+# A bucket is stored as one number, the time at which it is full again, so
+# a decision is a lookup and some arithmetic, without the database.
+RATE_LIMITS = os.environ.get('RATE_LIMITS') != 'false'
+
+
+# A rate like '10/60' allows 10 requests in 60 seconds, all of them at once
+# at most. 'off' disables it.
+def parse_rate(text):
+    if text is None or text.strip() in ('', 'off'):
+        return None
+    count, _, seconds = text.partition('/')
+    count, seconds = int(count), float(seconds or 1)
+    if count <= 0 or seconds <= 0:
+        raise ValueError(f'Invalid rate: {text}')
+    return count, seconds
+
+
+# Time at which a bucket filled at full_at is full again after taking a
+# token, and seconds to wait if the bucket is empty.
+#
+# Backends take a token from each of buckets, a list of (key, rate), or
+# from none of them if any is empty, so a refused request doesn't spend
+# tokens of other buckets. take() returns seconds to wait and the index of
+# the empty bucket, or 0 and None after taking the tokens.
+def take_token(full_at, now, rate):
+    count, seconds = rate
+    interval = seconds / count
+    # Seconds of tokens taken from the bucket. Comparing them with seconds
+    # instead of adding now and subtracting it again keeps rounding errors
+    # from refusing the last token of a bucket.
+    taken = max((full_at or now) - now, 0.0)
+    wait = taken + interval - seconds
+    return now + taken + interval, max(wait, 0.0)
+
+
+# Buckets of this process. At most max_size buckets are kept and the least
+# recently used one is dropped, which only refills it early.
+class LocalBackend:
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, buckets):
+        now = time.monotonic()
+        with self.lock:
+            taken = []
+            for i, (key, rate) in enumerate(buckets):
+                full_at, wait = take_token(self.buckets.get(key), now, rate)
+                if wait:
+                    return wait, i
+                taken.append((key, full_at))
+            for key, full_at in taken:
+                self.buckets[key] = full_at
+                self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+        return 0.0, None
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+    def stats(self):
+        return {
+            'backend': 'local',
+            'size': len(self.buckets)
+        }
+
+
+# Buckets on a store shared by workers, such as Redis. client should have
+# get(key) and set(key, value, ex=seconds), as clients of cache.py. Workers
+# taking a token of the same bucket at the same moment may both succeed, so
+# a burst can exceed a budget by the number of such requests.
+class SharedBackend:
+    def __init__(self, client, prefix='fcomment:rate:'):
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, buckets):
+        now = time.time()
+        taken = []
+        for i, (key, rate) in enumerate(buckets):
+            value = self.client.get(self.prefix + key)
+            full_at, wait = take_token(
+                float(value) if value is not None else None, now, rate
+            )
+            if wait:
+                return wait, i
+            taken.append((key, full_at))
+        for key, full_at in taken:
+            self.client.set(
+                self.prefix + key, repr(full_at), ex=math.ceil(full_at - now)
+            )
+        return 0.0, None
+
+    # Buckets of shared stores are left to expire when they are full.
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {
+            'backend': 'shared'
+        }
+
+
+# rates maps endpoints to rates for each user, and ip_rate is shared by all
+# limited endpoints for each client address.
+class RateLimiter:
+    def __init__(self, backend, rates, ip_rate=None):
+        self.backend = backend
+        self.rates = rates
+        self.ip_rate = ip_rate
+
+    # Seconds to wait before the user may request the endpoint, or 0 after
+    # taking tokens for it.
+    def check(self, endpoint, subject):
+        buckets, names = [], []
+        rate = self.rates.get(endpoint)
+        if rate is not None and subject is not None:
+            buckets.append((f'{endpoint}:{subject}', rate))
+            names.append('user')
+        if self.ip_rate is not None:
+            buckets.append((f'ip:{request.remote_addr}', self.ip_rate))
+            names.append('ip')
+        if not buckets:
+            return 0.0
+        wait, empty = self.backend.take(buckets)
+        if wait:
+            rate_limited.inc(endpoint, names[empty])
+        return wait
+
+    # Decorator for endpoints under requires_auth, so the subject is
+    # verified. It raises TooManyRequests if a bucket is empty.
+    def limit(self, f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            if RATE_LIMITS:
+                wait = self.check(f.__name__, payload.get('sub'))
+                if wait:
+                    raise TooManyRequests(
+                        description='Too many requests. Try again later.',
+                        retry_after=math.ceil(wait)
+                    )
+            return f(payload, *args, **kwargs)
+
+        return wrapper
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {
+            **self.backend.stats(),
+            'rates': {
+                endpoint: f'{count}/{seconds:g}'
+                for endpoint, (count, seconds) in self.rates.items()
+            }
+        }
+
+
+# url selects a backend as create_response_cache of cache.py:
+#   None or empty: buckets in each process
+#   memory://: shared backend on a local stand-in
+#   redis://...: shared backend on Redis, if redis package is installed
+def create_rate_limiter(url=None, rates=None, ip_rate=None, max_size=100000):
+    rates = {
+        endpoint: rate for endpoint, rate in (rates or {}).items()
+        if rate is not None
+    }
+    if not url:
+        return RateLimiter(LocalBackend(max_size), rates, ip_rate)
+    if url.startswith('memory://'):
+        return RateLimiter(SharedBackend(DictClient()), rates, ip_rate)
+
+    import redis
+    return RateLimiter(
+        SharedBackend(redis.Redis.from_url(url)), rates, ip_rate
+    )
@@ -0,0 +1,167 @@
+import re
+import json
+import datetime
+import functools
+from flask import current_app, jsonify as flask_jsonify, stream_with_context
+
+# orjson is used if it is installed, and json of the standard library
+# otherwise. Both write the same bytes as jsonify of Flask.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Bytes buffered before a chunk of a streamed response is sent.
+STREAM_BUFFER_SIZE = 16 * 1024
+
+DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = (
+    'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'
+)
+TWO_DIGITS = tuple(f'{i:02d}' for i in range(60))
+
+# Bytes the standard library escapes with ensure_ascii but orjson doesn't.
+NOT_ASCII = re.compile(b'[\x7f-\xff]')
+
+
+# Format a datetime the same as the JSON encoder of Flask, like
+# "Wed, 09 Sep 2020 16:20:28 GMT". Naive datetimes are in UTC.
+def http_date(value):
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return (
+        f'{http_day(value.toordinal())}{TWO_DIGITS[value.hour]}:'
+        f'{TWO_DIGITS[value.minute]}:{TWO_DIGITS[value.second]} GMT'
+    )
+
+
+# Comments of a thread are mostly posted on a few days, so the date part
+# is formatted once per day.
+@functools.lru_cache(maxsize=4096)
+def http_day(ordinal):
+    day = datetime.date.fromordinal(ordinal)
+    return (
+        f'{DAYS[day.weekday()]}, {day.day:02d} '
+        f'{MONTHS[day.month - 1]} {day.year:04d} '
+    )
+
+
+def default(value):
+    if isinstance(value, datetime.datetime):
+        return http_date(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+# Encode a value to compact JSON with sorted keys and escaped non-ASCII
+# characters, without a trailing newline.
+def encode(value):
+    if orjson is not None:
+        body = orjson.dumps(
+            value,
+            default=default,
+            option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        )
+        if NOT_ASCII.search(body) is None:
+            return body
+    return json.dumps(
+        value, default=default, separators=(',', ':'), sort_keys=True
+    ).encode()
+
+
+# Respond with the same body as jsonify of Flask, encoded by encode().
+def jsonify(body):
+    app = current_app
+    if not compact(app):
+        return flask_jsonify(body)
+    return app.response_class(
+        encode(body) + b'\n', mimetype=app.config['JSONIFY_MIMETYPE']
+    )
+
+
+# Whether jsonify of Flask writes compact JSON with sorted keys and escaped
+# non-ASCII characters, which encode() reproduces.
+def compact(app):
+    return (
+        app.config['JSON_SORT_KEYS'] and
+        app.config['JSON_AS_ASCII'] and
+        not app.config['JSONIFY_PRETTYPRINT_REGULAR'] and
+        not app.debug
+    )
+
+
+# Respond with a JSON object the same as jsonify(), but write the list of
+# key item by item while items are generated, so the entire list is never
+# kept in memory. A value of fields can be a function called when the value
+# is written, after items of a preceding key are generated.
+# If the body is at most max_body bytes, on_body is called with it at the
+# end, for example to cache it.
+def stream_json(fields, key, items, on_body=None, max_body=0):
+    app = current_app
+    if not compact(app):
+        # Pretty printed responses are for debugging, so build them at once.
+        body = {key: list(items)}
+        for name, value in fields.items():
+            body[name] = value() if callable(value) else value
+        response = flask_jsonify(body)
+        if on_body is not None:
+            on_body(response.get_data())
+        return response
+
+    def generate():
+        yield b'{'
+        for i, name in enumerate(sorted([*fields, key])):
+            if i > 0:
+                yield b','
+            yield encode(name) + b':'
+            if name == key:
+                yield b'['
+                for j, item in enumerate(items):
+                    yield b',' + encode(item) if j > 0 else encode(item)
+                yield b']'
+            else:
+                value = fields[name]
+                yield encode(value() if callable(value) else value)
+        yield b'}\n'
+
+    chunks = buffered(generate())
+    if on_body is not None:
+        chunks = captured(chunks, on_body, max_body)
+    return app.response_class(
+        stream_with_context(chunks),
+        mimetype=app.config['JSONIFY_MIMETYPE']
+    )
+
+
+# Join small chunks into chunks of about STREAM_BUFFER_SIZE bytes.
+def buffered(chunks):
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_BUFFER_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+# Pass chunks through, and call on_body with all of them joined if they are
+# at most max_body bytes in total.
+def captured(chunks, on_body, max_body):
+    body = []
+    size = 0
+    for chunk in chunks:
+        if body is not None:
+            size += len(chunk)
+            if size <= max_body:
+                body.append(chunk)
+            else:
+                body = None
+        yield chunk
+    if body is not None:
+        on_body(b''.join(body))
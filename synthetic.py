@@ -0,0 +1,173 @@
+# Synthetic users, articles and comment forests to measure how the API
+# scales. The same arguments and seed generate the same data. Ids start
+# with PREFIX, so generated data can be removed again.
+#
+# Articles get top level comments by popularity: the i-th article gets a
+# share of 1 / i ** skew of them. Every comment above max_depth gets
+# replies, and both counts are drawn from the distribution around their
+# means. A comment having replies is removed with the given probability.
+import math
+import random
+import datetime
+
+from models import (
+    COMMENT_DEPTH_MAX,
+    Article,
+    Comment,
+    TableVersion,
+    User,
+    comment_path,
+    db,
+    new_version
+)
+
+PREFIX = 'synthetic'
+DISTRIBUTIONS = ('fixed', 'poisson', 'geometric')
+
+
+# A count drawn from the distribution with the given mean.
+def draw(rng, distribution, mean):
+    if mean <= 0:
+        return 0
+    if distribution == 'fixed':
+        whole = int(mean)
+        return whole + (rng.random() < mean - whole)
+    if distribution == 'poisson':
+        if mean > 30:
+            return max(0, round(rng.gauss(mean, math.sqrt(mean))))
+        limit = math.exp(-mean)
+        count = 0
+        product = rng.random()
+        while product > limit:
+            count += 1
+            product *= rng.random()
+        return count
+    if distribution == 'geometric':
+        # Failures before a success of probability 1 / (1 + mean).
+        return int(math.log(1.0 - rng.random()) / math.log(mean / (1 + mean)))
+    raise ValueError(f'Unknown distribution: {distribution}')
+
+
+def user_id(i):
+    return f'{PREFIX}|{i:06d}'
+
+
+def article_id(i):
+    return f'{PREFIX}-{i:04d}'
+
+
+# Comments of an article in breadth-first order, so parents are inserted
+# before their replies.
+def generate_thread(rng, article, first_id, started_at, roots, users, fanout,
+                    max_depth, distribution, removed):
+    rows = []
+    level = [None] * draw(rng, distribution, roots)
+    for depth in range(max_depth + 1):
+        children = []
+        for parent in level:
+            id = first_id + len(rows)
+            if parent is None:
+                posted_at = started_at + datetime.timedelta(
+                    seconds=rng.randrange(30 * 24 * 3600)
+                )
+            else:
+                posted_at = parent['datetime'] + datetime.timedelta(
+                    seconds=rng.randrange(1, 24 * 3600)
+                )
+            row = {
+                'id': id,
+                'datetime': posted_at,
+                'user': rng.choice(users),
+                'content': f'Comment {id} of {article}',
+                'article': article,
+                'parent': parent and parent['id'],
+                'removed': False,
+                'path': comment_path(id, parent and parent['path']),
+                'depth': depth
+            }
+            rows.append(row)
+            children.append(row)
+        if depth == max_depth:
+            break
+        level = []
+        for parent in children:
+            replies = draw(rng, distribution, fanout)
+            if replies and rng.random() < removed:
+                parent.update(user=None, content=None, removed=True)
+            level.extend([parent] * replies)
+        if not level:
+            break
+    return rows
+
+
+# Insert synthetic data and return the number of inserted rows by table.
+def generate(users=100, articles=20, roots=10, fanout=1.0, max_depth=5,
+             distribution='geometric', skew=1.0, removed=0.02, seed=0,
+             chunk=10000):
+    if max_depth > COMMENT_DEPTH_MAX:
+        raise ValueError(
+            f'max_depth is limited to {COMMENT_DEPTH_MAX} levels.'
+        )
+    rng = random.Random(seed)
+    user_ids = [user_id(i) for i in range(users)]
+    db.session.execute(User.__table__.insert(), [
+        {
+            'id': id,
+            'nickname': f'{PREFIX} user {i}',
+            'picture': f'https://example.com/{PREFIX}/{i}.png'
+        }
+        for i, id in enumerate(user_ids)
+    ])
+
+    weights = [1 / (i + 1) ** skew for i in range(articles)]
+    total_weight = sum(weights)
+    next_id = (db.session.query(db.func.max(Comment.id)).scalar() or 0) + 1
+    started_at = datetime.datetime(2020, 9, 1)
+    comments = 0
+    for i, weight in enumerate(weights):
+        article = article_id(i)
+        rows = generate_thread(
+            rng, article, next_id, started_at,
+            roots * articles * weight / total_weight, user_ids, fanout,
+            max_depth, distribution, removed
+        )
+        db.session.execute(Article.__table__.insert(), {
+            'id': article,
+            'comment_count': sum(1 for r in rows if not r['removed']),
+            'version': new_version()
+        })
+        for start in range(0, len(rows), chunk):
+            db.session.execute(
+                Comment.__table__.insert(), rows[start:start + chunk]
+            )
+        next_id += len(rows)
+        comments += len(rows)
+
+    # Comments were inserted with ids, so the sequence of PostgreSQL has to
+    # continue after them.
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(
+            "SELECT setval(pg_get_serial_sequence('comments', 'id'), "
+            "(SELECT max(id) FROM comments))"
+        )
+    TableVersion.bump(User.__tablename__)
+    TableVersion.bump(Article.__tablename__)
+    db.session.commit()
+    return {'users': users, 'articles': articles, 'comments': comments}
+
+
+# Remove synthetic data and return the number of removed rows by table.
+def clear():
+    articles = Article.query.filter(Article.id.like(f'{PREFIX}-%'))
+    article_ids = [id for id, in articles.with_entities(Article.id)]
+    comments = Comment.query.filter(Comment.article.in_(article_ids)).delete(
+        synchronize_session=False
+    )
+    articles = articles.delete(synchronize_session=False)
+    users = User.query.filter(User.id.like(f'{PREFIX}|%')).delete(
+        synchronize_session=False
+    )
+    TableVersion.bump(User.__tablename__)
+    TableVersion.bump(Article.__tablename__)
+    db.session.commit()
+    return {'users': users, 'articles': articles, 'comments': comments}
@@ -8,8 +8,55 @@ except Exception:
 import os
 import unittest
 import json
+import time
+import random
+import hashlib
+import threading
+import datetime
+import tempfile
+from unittest import mock
+from flask import json as flask_json
+from pytz import utc
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from werkzeug.http import http_date as werkzeug_http_date
 
-from app import app
+from app import (
+    app,
+    get_engine_options,
+    limiter,
+    recent_writers,
+    thread_cache
+)
+from auth import (
+    AuthError,
+    JWKSKeyStore,
+    verified_tokens,
+    verify_decode_jwt
+)
+from cache import (
+    DictClient,
+    LRUCache,
+    LocalBackend,
+    ResponseCache,
+    SharedBackend,
+    create_response_cache
+)
+from models import (
+    COMMENT_DEPTH_MAX,
+    db,
+    Article,
+    Comment,
+    TableVersion,
+    User,
+    comment_path,
+    replicas
+)
+from serialization import encode, http_date
+import compression
+import metrics
+import ratelimit
+import synthetic
 
 
 class FCommentTestCase(unittest.TestCase):
@@ -47,6 +94,28 @@ class FCommentTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(len(data['users']), 3)
 
+    def test_get_users_by_ids(self):
+        manager_id = 'auth0|5f3e92f9fe4527006d9383bc'
+        res = self.client().get(
+            f'/users?id={manager_id}&id={manager_id}&id=unknown-user'
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([u['id'] for u in data['users']], [manager_id])
+
+    def test_get_users_pages(self):
+        res = self.client().get('/users?per_page=2')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['users']), 2)
+
+        res = self.client().get(
+            f'/users?per_page=2&cursor={data["next_cursor"]}'
+        )
+        data = json.loads(res.data)
+        self.assertEqual(len(data['users']), 1)
+        self.assertIsNone(data['next_cursor'])
+
     # POST /users
     def test_update_users(self):
         # Get users
@@ -79,6 +148,42 @@ class FCommentTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(len(data['articles']), 3)
 
+    # GET /articles/counts
+    def test_get_article_counts(self):
+        res = self.client().get(
+            '/articles/counts?id=new-beginnings&id=unknown-article'
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['counts']['unknown-article'], 0)
+
+        res = self.client().get('/articles/new-beginnings/comments')
+        count = json.loads(res.data)['count']
+        self.assertEqual(data['counts']['new-beginnings'], count)
+
+    def test_article_counts_follow_comments(self):
+        def get_count():
+            res = self.client().get('/articles/counts?id=hello-world')
+            return json.loads(res.data)['counts']['hello-world']
+
+        count = get_count()
+        res = self.client().post('articles/hello-world/comments', headers={
+                'Authorization': f'Bearer {os.environ["JWT_BARISTA"]}'
+            },
+            json={
+                'content': 'Test comment for GET /articles/counts'
+            }
+        )
+        comment_id = json.loads(res.data)['id']
+        self.assertEqual(get_count(), count + 1)
+
+        res = self.client().delete(f'comments/{comment_id}', headers={
+                'Authorization': f'Bearer {os.environ["JWT_BARISTA"]}'
+            }
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(get_count(), count)
+
     # POST /articles & DELETE /articles/:id
     def test_post_and_delete_articles(self):
         # Post article
@@ -103,6 +208,78 @@ class FCommentTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['id'], 'new-post')
 
+    # POST /articles/bulk
+    def test_post_articles_bulk(self):
+        res = self.client().post('/articles/bulk', headers={
+                'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'
+            },
+            json={
+                'ids': ['new-beginnings', 'bulk-post-1', 'bulk-post-2']
+            })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], ['bulk-post-1', 'bulk-post-2'])
+        self.assertEqual(data['existing'], ['new-beginnings'])
+
+        for id in data['created']:
+            res = self.client().delete(f'/articles/{id}', headers={
+                    'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'
+                })
+            self.assertEqual(res.status_code, 200)
+
+    def test_post_articles_bulk_with_invalid_ids(self):
+        res = self.client().post('/articles/bulk', headers={
+                'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'
+            },
+            json={
+                'ids': 'bulk-post'
+            })
+        self.assertEqual(res.status_code, 422)
+
+    def test_post_articles_bulk_with_list_body(self):
+        res = self.client().post('/articles/bulk', headers={
+                'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'
+            },
+            json=['bulk-post-1', 'bulk-post-2'])
+        self.assertEqual(res.status_code, 422)
+
+        res = self.client().post('/articles/bulk', headers={
+                'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'
+            },
+            data='bulk-post-1')
+        self.assertEqual(res.status_code, 422)
+
+    def test_delete_article_with_comments(self):
+        manager = {'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'}
+        self.client().post('/articles', headers=manager, json={
+            'id': 'cascade-post'
+        })
+        parent_id = None
+        for i in range(10):
+            url = (
+                f'comments/{parent_id}' if parent_id
+                else 'articles/cascade-post/comments'
+            )
+            res = self.client().post(url, headers=manager, json={
+                'content': f'Comment {i} to be removed with the article'
+            })
+            parent_id = json.loads(res.data)['id'] if i % 2 == 0 else None
+
+        res = self.client().delete('/articles/cascade-post', headers=manager)
+        self.assertEqual(res.status_code, 200)
+
+        # Check no orphaned comments remain.
+        with app.app_context():
+            self.assertEqual(
+                Comment.query.filter_by(article='cascade-post').count(), 0
+            )
+            self.assertEqual(
+                Comment.query.filter(
+                    Comment.parent.isnot(None),
+                    ~Comment.parent.in_(db.session.query(Comment.id))
+                ).count(), 0
+            )
+
     # RBAC test for POST /articles
     def test_post_article_with_inappropriate_role(self):
         res = self.client().post('/articles', headers={
@@ -163,6 +340,25 @@ class FCommentTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertGreater(len(data['comments']), 0)
 
+    def test_get_comments_with_cursor(self):
+        res = self.client().get('/comments?per_page=1')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['comments']), 1)
+        first = data['comments'][0]
+
+        res = self.client().get(
+            f'/comments?per_page=1&cursor={data["next_cursor"]}'
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['comments']), 1)
+        self.assertNotEqual(data['comments'][0]['id'], first['id'])
+
+    def test_get_comments_with_invalid_cursor(self):
+        res = self.client().get('/comments?cursor=invalid')
+        self.assertEqual(res.status_code, 422)
+
     # GET /comments/:id
     def test_get_comment(self):
         res = self.client().get('/comments/16')
@@ -313,6 +509,1425 @@ class FCommentTestCase(unittest.TestCase):
             pass
         self.assertIsNone(removed_comment)
 
+    def test_delete_subtree(self):
+        manager = {'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'}
+        res = self.client().get('/articles/counts?id=hello-world')
+        count = json.loads(res.data)['counts']['hello-world']
+
+        res = self.client().post('articles/hello-world/comments',
+                                 headers=manager,
+                                 json={'content': 'Root of a subtree'})
+        root_id = json.loads(res.data)['id']
+        parent_id = root_id
+        for i in range(3):
+            res = self.client().post(f'comments/{parent_id}',
+                                     headers=manager,
+                                     json={'content': f'Reply {i}'})
+            parent_id = json.loads(res.data)['id']
+
+        # Only administrators can delete a subtree.
+        barista = {'Authorization': f'Bearer {os.environ["JWT_BARISTA"]}'}
+        res = self.client().delete(f'comments/{root_id}?subtree=true',
+                                   headers=barista)
+        self.assertEqual(res.status_code, 403)
+
+        res = self.client().delete(f'comments/{root_id}?subtree=true',
+                                   headers=manager)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/articles/hello-world/comments')
+        data = json.loads(res.data)
+        self.assertNotIn(root_id, [c['id'] for c in data['comments']])
+        self.assertEqual(data['count'], count)
+        res = self.client().get(f'/comments/{parent_id}')
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_thread_pages(self):
+        manager = {'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'}
+        self.client().post('/articles', headers=manager, json={
+            'id': 'paged-post'
+        })
+        top_ids = []
+        for i in range(3):
+            res = self.client().post('articles/paged-post/comments',
+                                     headers=manager,
+                                     json={'content': f'Comment {i}'})
+            top_ids.append(json.loads(res.data)['id'])
+        reply_ids = [top_ids[0]]
+        for i in range(3):
+            res = self.client().post(f'comments/{reply_ids[-1]}',
+                                     headers=manager,
+                                     json={'content': f'Reply {i}'})
+            reply_ids.append(json.loads(res.data)['id'])
+
+        res = self.client().get(
+            '/articles/paged-post/comments?per_page=2&depth=1'
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['count'], 6)
+        self.assertEqual([c['id'] for c in data['comments']], top_ids[:2])
+        reply = data['comments'][0]['replies'][0]
+        self.assertEqual(reply['id'], reply_ids[1])
+        self.assertNotIn('replies', reply)
+        self.assertEqual(reply['reply_count'], 1)
+        self.assertTrue(reply['has_more_replies'])
+        self.assertNotIn('has_more_replies', data['comments'][1])
+
+        res = self.client().get(
+            '/articles/paged-post/comments?per_page=2&depth=1'
+            f'&cursor={data["next_cursor"]}'
+        )
+        data = json.loads(res.data)
+        self.assertEqual([c['id'] for c in data['comments']], top_ids[2:])
+        self.assertIsNone(data['next_cursor'])
+
+        # Expand the replies cut off.
+        res = self.client().get(f'/comments/{reply_ids[1]}/replies?depth=0')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([c['id'] for c in data['comments']], reply_ids[2:3])
+        self.assertEqual(data['comments'][0]['reply_count'], 1)
+
+        res = self.client().delete('/articles/paged-post', headers=manager)
+        self.assertEqual(res.status_code, 200)
+
+    def test_get_comments_with_users(self):
+        def user_ids(comments):
+            ids = set()
+            for c in comments:
+                if c.get('user') is not None:
+                    ids.add(c['user'])
+                ids |= user_ids(c.get('replies', []))
+            return ids
+
+        for url in ['/articles/new-beginnings/comments?include=users',
+                    '/articles/new-beginnings/comments?include=users&depth=1',
+                    '/comments?include=users']:
+            res = self.client().get(url)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertGreater(len(data['users']), 0)
+            self.assertEqual(set(data['users']), user_ids(data['comments']))
+
+        res = self.client().get('/articles/new-beginnings/comments')
+        self.assertNotIn('users', json.loads(res.data))
+
+    def test_thread_with_users_etag_follows_users(self):
+        url = '/articles/new-beginnings/comments?include=users'
+        etag = self.client().get(url).headers['ETag']
+
+        res = self.client().get('/users?per_page=1')
+        user = json.loads(res.data)['users'][0]
+        with app.app_context():
+            User.query.get(user['id']).update()
+
+        res = self.client().get(url, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_replies_of_unknown_comment(self):
+        res = self.client().get('/comments/987654321/replies')
+        self.assertEqual(res.status_code, 404)
+
+    def test_rows_format_as_instances(self):
+        with app.app_context():
+            for model, query in [
+                (Comment, Comment.thread_query('new-beginnings')),
+                (User, User.query.order_by(User.id))
+            ]:
+                rows = model.rows(query)
+                self.assertGreater(len(rows), 0)
+                self.assertFalse(hasattr(rows[0], '__dict__'))
+                self.assertEqual(
+                    [r.format() for r in rows],
+                    [i.format() for i in query.all()]
+                )
+
+    def test_comment_paths(self):
+        manager = {'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'}
+        res = self.client().post('articles/hello-world/comments',
+                                 headers=manager,
+                                 json={'content': 'Root of a chain'})
+        ids = [json.loads(res.data)['id']]
+        for i in range(5):
+            res = self.client().post(f'comments/{ids[-1]}',
+                                     headers=manager,
+                                     json={'content': f'Reply {i}'})
+            ids.append(json.loads(res.data)['id'])
+
+        with app.app_context():
+            root = Comment.query.get(ids[0])
+            last = Comment.query.get(ids[-1])
+            self.assertEqual(last.depth, 5)
+            self.assertEqual(
+                [c.id for c in Comment.ancestors_query(last)], ids[:-1]
+            )
+            self.assertEqual(
+                sorted(c.id for c in Comment.subtree_query(root)), ids
+            )
+            self.assertEqual(
+                sorted(c.id for c in Comment.subtree_query(root, depth=2)),
+                ids[:3]
+            )
+
+        res = self.client().delete(f'comments/{ids[0]}?subtree=true',
+                                   headers=manager)
+        self.assertEqual(res.status_code, 200)
+
+
+# Record SQL statements executed while the block runs.
+class StatementLog:
+    def __init__(self):
+        self.statements = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        self.statements.append(statement)
+
+    def on_table(self, table):
+        return [
+            s for s in self.statements
+            if f'FROM {table}' in s or f'UPDATE {table}' in s
+        ]
+
+    def __enter__(self):
+        event.listen(
+            db.engine, 'before_cursor_execute', self._before_cursor_execute
+        )
+        return self
+
+    def __exit__(self, *args):
+        event.remove(
+            db.engine, 'before_cursor_execute', self._before_cursor_execute
+        )
+
+
+# Record query plans of SELECT statements executed while the block runs.
+class QueryPlans:
+    def __init__(self):
+        self.plans = []
+        self.dialect = db.engine.dialect.name
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        if not statement.lstrip().upper().startswith('SELECT'):
+            return
+        if self.dialect == 'postgresql':
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        else:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            plan = '\n'.join(row[-1] for row in cursor.fetchall())
+        self.plans.append((statement, plan))
+
+    def sequential_scans(self, table):
+        if self.dialect == 'postgresql':
+            return [
+                (s, p) for s, p in self.plans
+                if f'Seq Scan on {table}' in p
+            ]
+        return [
+            (s, p) for s, p in self.plans
+            if any(
+                line.strip().startswith(f'SCAN {table}') and
+                'INDEX' not in line
+                for line in p.splitlines()
+            )
+        ]
+
+    def __enter__(self):
+        event.listen(
+            db.engine, 'before_cursor_execute', self._before_cursor_execute
+        )
+        return self
+
+    def __exit__(self, *args):
+        event.remove(
+            db.engine, 'before_cursor_execute', self._before_cursor_execute
+        )
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    ARTICLES = [f'query-plan-{i}' for i in range(20)]
+    FIRST_ID = 1000000
+
+    # Seed 20 articles having 1,000 comments each.
+    # Every fifth comment is a reply and every tenth comment is removed.
+    @classmethod
+    def setUpClass(cls):
+        with app.app_context():
+            db.session.execute(
+                Article.__table__.insert(),
+                [{'id': a} for a in cls.ARTICLES]
+            )
+            rows = []
+            now = datetime.datetime(2020, 9, 1)
+            for i in range(len(cls.ARTICLES) * 1000):
+                id = cls.FIRST_ID + i
+                parent = rows[-1] if i % 5 == 4 else None
+                rows.append({
+                    'id': id,
+                    'datetime': now + datetime.timedelta(seconds=i),
+                    'user': None,
+                    'content': f'Comment {id}',
+                    'article': cls.ARTICLES[i // 1000],
+                    'parent': parent and parent['id'],
+                    'removed': i % 10 == 0,
+                    'path': comment_path(id, parent and parent['path']),
+                    'depth': 1 if parent else 0
+                })
+            db.session.execute(Comment.__table__.insert(), rows)
+            db.session.commit()
+            db.session.execute('ANALYZE')
+            db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        with app.app_context():
+            Comment.query.filter(Comment.id >= cls.FIRST_ID).delete()
+            Article.query.filter(Article.id.in_(cls.ARTICLES)).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client
+        thread_cache.clear()
+
+    def assertNoSequentialScan(self, method, url, **kwargs):
+        with QueryPlans() as plans:
+            res = getattr(self.client(), method)(url, **kwargs)
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(len(plans.plans), 0)
+        self.assertEqual(plans.sequential_scans('comments'), [])
+        return res
+
+    def test_get_comments_from_article(self):
+        self.assertNoSequentialScan('get', '/articles/query-plan-7/comments')
+
+    def test_get_comments(self):
+        res = self.assertNoSequentialScan('get', '/comments')
+        cursor = json.loads(res.data)['next_cursor']
+        self.assertNoSequentialScan('get', f'/comments?cursor={cursor}')
+
+    def test_get_comment(self):
+        self.assertNoSequentialScan('get', f'/comments/{self.FIRST_ID + 1}')
+
+    def test_delete_comment(self):
+        self.assertNoSequentialScan(
+            'delete', f'/comments/{self.FIRST_ID + 3}',
+            headers={'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'}
+        )
+
+    def test_get_thread_page(self):
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest('LIKE of SQLite cannot use the path index.')
+        self.assertNoSequentialScan(
+            'get', '/articles/query-plan-7/comments?per_page=20&depth=2'
+        )
+
+    def test_get_replies(self):
+        self.assertNoSequentialScan(
+            'get', f'/comments/{self.FIRST_ID + 3}/replies?depth=0'
+        )
+
+    def test_subtree_and_ancestors(self):
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest('LIKE of SQLite cannot use the path index.')
+        with app.app_context():
+            comment = Comment.query.get(self.FIRST_ID + 4)
+            with QueryPlans() as plans:
+                Comment.subtree_query(comment).all()
+                Comment.subtree_query(comment, depth=1).all()
+                Comment.ancestors_query(comment).all()
+            self.assertEqual(plans.sequential_scans('comments'), [])
+
+
+# Most SQL statements a request may execute, whatever the size of the data it
+# reads. Requests run on a small and a large thread, so a query per comment
+# exceeds the budget.
+class QueryBudgetTestCase(unittest.TestCase):
+    FIRST_ID = 2000000
+    SIZES = {'query-budget-small': 4, 'query-budget-large': 400}
+    USERS = [
+        'auth0|5f3e92f9fe4527006d9383bc',
+        'auth0|5f3e93dbb230300067050510',
+        'auth0|5f5dc52e15ab3a00772d41b3'
+    ]
+    BUDGETS = [
+        ('get', '/users', 2),
+        ('get', '/users?per_page=2', 2),
+        ('get', '/articles', 2),
+        ('get', '/articles/counts?id={article}&id=unknown', 1),
+        ('get', '/articles/{article}/comments', 2),
+        ('get', '/articles/{article}/comments?include=users', 4),
+        ('get', '/articles/{article}/comments?per_page=5&depth=2', 5),
+        ('get', '/comments', 1),
+        ('get', '/comments/{comment}', 1),
+        ('get', '/comments/{comment}/replies', 3),
+        ('post', '/articles/{article}/comments', 4),
+        ('post', '/comments/{comment}', 5),
+        ('patch', '/comments/{comment}', 3),
+        ('delete', '/comments/{comment}', 5)
+    ]
+
+    # Comments are seeded in groups of five replying to the last comment of
+    # the group before, so the large thread is 80 levels deep with five
+    # replies on each level. Requests use the deepest comment of the manager.
+    @classmethod
+    def setUpClass(cls):
+        with app.app_context():
+            db.session.execute(
+                Article.__table__.insert(),
+                [{'id': a, 'comment_count': n} for a, n in cls.SIZES.items()]
+            )
+            rows = []
+            now = datetime.datetime(2020, 9, 1)
+            for article, size in cls.SIZES.items():
+                first = len(rows)
+                for i in range(size):
+                    id = cls.FIRST_ID + len(rows)
+                    parent = rows[first + i - 1 - i % 5] if i >= 5 else None
+                    rows.append({
+                        'id': id,
+                        'datetime': now + datetime.timedelta(seconds=id),
+                        'user': cls.USERS[i % 3],
+                        'content': f'Comment {id}',
+                        'article': article,
+                        'parent': parent and parent['id'],
+                        'removed': False,
+                        'path': comment_path(id, parent and parent['path']),
+                        'depth': parent['depth'] + 1 if parent else 0
+                    })
+            db.session.execute(Comment.__table__.insert(), rows)
+            db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        with app.app_context():
+            Comment.query.filter(Comment.article.in_(cls.SIZES)).delete(
+                synchronize_session=False
+            )
+            Article.query.filter(Article.id.in_(cls.SIZES)).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client
+        thread_cache.clear()
+
+    def assertQueryBudget(self, budget, method, url, **kwargs):
+        with StatementLog() as log:
+            res = getattr(self.client(), method)(url, **kwargs)
+        self.assertEqual(res.status_code, 200, url)
+        self.assertLessEqual(
+            len(log.statements), budget,
+            f'{method.upper()} {url} executed {len(log.statements)} '
+            f'statements over its budget:\n' + '\n'.join(log.statements)
+        )
+
+    def test_budgets(self):
+        headers = {'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'}
+        for article in self.SIZES:
+            with app.app_context():
+                comment = Comment.query.filter_by(
+                    article=article, user=self.USERS[0]
+                ).order_by(
+                    Comment.depth.desc(), Comment.id
+                ).first()
+            for method, url, budget in self.BUDGETS:
+                with self.subTest(method=method, url=url, article=article):
+                    kwargs = {}
+                    if method != 'get':
+                        kwargs['headers'] = headers
+                    if method in ('post', 'patch'):
+                        kwargs['json'] = {'content': 'Comment in budget'}
+                    self.assertQueryBudget(
+                        budget, method,
+                        url.format(article=article, comment=comment.id),
+                        **kwargs
+                    )
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client
+        thread_cache.clear()
+
+    def test_local_backend_eviction(self):
+        backend = LocalBackend(max_size=10, max_bytes=8)
+        backend.set('a', b'1234')
+        backend.set('b', b'5678')
+        backend.set('c', b'9')
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get('b'), b'5678')
+        self.assertEqual(backend.stats()['bytes'], 5)
+
+    def test_response_cache_version(self):
+        cache = ResponseCache(LocalBackend())
+        cache.set('a', b'1234', 'v1')
+        self.assertEqual(cache.get('a', 'v1'), b'1234')
+        self.assertIsNone(cache.get('a', 'v2'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_shared_backend(self):
+        cache = create_response_cache('memory://')
+        cache.set('a', b'1234')
+        self.assertEqual(cache.get('a'), b'1234')
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+    def test_thread_cache_invalidation(self):
+        res = self.client().get('/articles/hello-world/comments')
+        count = json.loads(res.data)['count']
+        hits = thread_cache.stats()['hits']
+        res = self.client().get('/articles/hello-world/comments')
+        self.assertEqual(json.loads(res.data)['count'], count)
+        self.assertEqual(thread_cache.stats()['hits'], hits + 1)
+
+        res = self.client().post('articles/hello-world/comments', headers={
+                'Authorization': f'Bearer {os.environ["JWT_BARISTA"]}'
+            },
+            json={
+                'content': 'Test comment for the thread cache'
+            }
+        )
+        comment_id = json.loads(res.data)['id']
+        res = self.client().get('/articles/hello-world/comments')
+        self.assertEqual(json.loads(res.data)['count'], count + 1)
+
+        res = self.client().delete(f'comments/{comment_id}', headers={
+                'Authorization': f'Bearer {os.environ["JWT_BARISTA"]}'
+            }
+        )
+        res = self.client().get('/articles/hello-world/comments')
+        self.assertEqual(json.loads(res.data)['count'], count)
+
+    # Unknown or reordered parameters share an entry.
+    def test_thread_cache_key(self):
+        url = '/articles/hello-world/comments'
+        self.client().get(f'{url}?per_page=5&depth=2')
+        hits = thread_cache.stats()['hits']
+        for query in ('depth=2&per_page=5', 'per_page=5&depth=2&x=1'):
+            res = self.client().get(f'{url}?{query}')
+            self.assertEqual(res.status_code, 200)
+        self.assertEqual(thread_cache.stats()['hits'], hits + 2)
+
+        self.client().get(f'{url}?per_page=6&depth=2')
+        self.assertEqual(thread_cache.stats()['hits'], hits + 2)
+
+    @mock.patch('app.MONITORING_ENDPOINTS', True)
+    def test_get_cache_stats(self):
+        res = self.client().get('/cache/stats')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('hit_ratio', data['thread_cache'])
+
+
+class ConcurrentDeleteTestCase(unittest.TestCase):
+    ARTICLE = 'concurrent-post'
+
+    def setUp(self):
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest('Row locks need PostgreSQL.')
+        self.client = app.test_client
+        with app.app_context():
+            Article.insert_many([self.ARTICLE])
+
+    def tearDown(self):
+        with app.app_context():
+            Article.query.get(self.ARTICLE).delete()
+
+    # Workers reply to and delete random comments of chains in parallel.
+    def test_concurrent_replies_and_deletes(self):
+        manager = {'Authorization': f'Bearer {os.environ["JWT_MANAGER"]}'}
+        ids = []
+        for i in range(5):
+            res = self.client().post(f'articles/{self.ARTICLE}/comments',
+                                     headers=manager,
+                                     json={'content': f'Root {i}'})
+            parent_id = json.loads(res.data)['id']
+            ids.append(parent_id)
+            for j in range(3):
+                res = self.client().post(f'comments/{parent_id}',
+                                         headers=manager,
+                                         json={'content': f'Reply {j}'})
+                parent_id = json.loads(res.data)['id']
+                ids.append(parent_id)
+
+        lock = threading.Lock()
+        statuses = []
+
+        def work(seed):
+            rand = random.Random(seed)
+            client = app.test_client()
+            for _ in range(30):
+                with lock:
+                    id = rand.choice(ids)
+                if rand.random() < 0.5:
+                    res = client.post(f'comments/{id}', headers=manager,
+                                      json={'content': 'Concurrent reply'})
+                    if res.status_code == 200:
+                        with lock:
+                            ids.append(json.loads(res.data)['id'])
+                else:
+                    res = client.delete(f'comments/{id}', headers=manager)
+                with lock:
+                    statuses.append(res.status_code)
+
+        workers = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.assertTrue(all(s in (200, 404, 422) for s in statuses))
+
+        # Check the tree is consistent.
+        with app.app_context():
+            comments = Comment.query.filter_by(article=self.ARTICLE).all()
+            found = {c.id for c in comments}
+            parents = {c.parent for c in comments}
+            for c in comments:
+                # No orphaned replies.
+                self.assertTrue(c.parent is None or c.parent in found)
+                # Removed comments have replies.
+                self.assertTrue(not c.removed or c.id in parents)
+            self.assertEqual(
+                Article.query.get(self.ARTICLE).comment_count,
+                sum(1 for c in comments if not c.removed)
+            )
+
+    # First changes of a table create its version in parallel.
+    def test_concurrent_first_bumps(self):
+        name = 'concurrent-table'
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def work():
+            with app.app_context():
+                barrier.wait()
+                try:
+                    TableVersion.bump(name)
+                    db.session.commit()
+                except Exception as e:
+                    errors.append(e)
+                    db.session.rollback()
+
+        workers = [threading.Thread(target=work) for _ in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        with app.app_context():
+            count = TableVersion.query.filter_by(name=name).count()
+            TableVersion.query.filter_by(name=name).delete()
+            db.session.commit()
+        self.assertEqual(errors, [])
+        self.assertEqual(count, 1)
+
+
+# Paths of comments at the deepest level still fit the index of PostgreSQL,
+# and deeper replies are refused.
+class CommentDepthTestCase(unittest.TestCase):
+    ARTICLE = 'deep-post'
+    FIRST_ID = 3000000
+
+    def setUp(self):
+        self.client = app.test_client
+        with app.app_context():
+            Article.insert_many([self.ARTICLE])
+            rows, path = [], None
+            # A chain down to the level above the deepest.
+            for depth in range(COMMENT_DEPTH_MAX):
+                id = self.FIRST_ID + depth
+                path = comment_path(id, path)
+                rows.append({
+                    'id': id,
+                    'datetime': datetime.datetime(2020, 9, 1),
+                    'user': None,
+                    'content': f'Level {depth}',
+                    'article': self.ARTICLE,
+                    'parent': id - 1 if depth else None,
+                    'removed': False,
+                    'path': path,
+                    'depth': depth
+                })
+            db.session.execute(Comment.__table__.insert(), rows)
+            db.session.commit()
+            self.last_id = rows[-1]['id']
+
+    def tearDown(self):
+        with app.app_context():
+            Article.query.get(self.ARTICLE).delete()
+
+    def test_deepest_reply(self):
+        barista = {'Authorization': f'Bearer {os.environ["JWT_BARISTA"]}'}
+        res = self.client().post(f'comments/{self.last_id}',
+                                 headers=barista, json={'content': 'Deepest'})
+        self.assertEqual(res.status_code, 200)
+        id = json.loads(res.data)['id']
+        with app.app_context():
+            self.assertEqual(Comment.query.get(id).depth, COMMENT_DEPTH_MAX)
+
+        res = self.client().post(f'comments/{id}', headers=barista,
+                                 json={'content': 'Too deep'})
+        self.assertEqual(res.status_code, 400)
+
+
+class HealthTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client
+
+    def test_health(self):
+        res = self.client().get('/health')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['database'], 'ok')
+        self.assertFalse(data['pool']['saturated'])
+
+    def test_health_of_saturated_pool(self):
+        stats = {'class': 'QueuePool', 'saturated': True}
+        with mock.patch('app.db_pool_stats', return_value=stats), \
+                mock.patch('app.db_ping') as ping:
+            res = self.client().get('/health')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['database'], 'skipped')
+        ping.assert_not_called()
+
+    def test_health_of_unavailable_database(self):
+        with mock.patch('app.db_ping', return_value=False):
+            res = self.client().get('/health')
+        self.assertEqual(res.status_code, 503)
+
+    # Lost connections are 503 instead of 422 or 500.
+    def test_lost_connection(self):
+        error = OperationalError(
+            'SELECT 1', {}, Exception('server closed the connection'),
+            connection_invalidated=True
+        )
+        with mock.patch.object(Comment, 'get_row', side_effect=error):
+            res = self.client().get('/comments/21')
+        self.assertEqual(res.status_code, 503)
+
+        with mock.patch.object(Comment, 'insert', side_effect=error):
+            res = self.client().post('articles/hello-world/comments', headers={
+                    'Authorization': f'Bearer {os.environ["JWT_BARISTA"]}'
+                },
+                json={'content': 'Comment while the database is down'})
+        self.assertEqual(res.status_code, 503)
+
+    def test_engine_options(self):
+        env = {'DB_POOL_SIZE': '20', 'DB_STATEMENT_TIMEOUT': '5000'}
+        with mock.patch.dict(os.environ, env):
+            options = get_engine_options('postgres://localhost/fcomment')
+            self.assertEqual(options['pool_size'], 20)
+            self.assertTrue(options['pool_pre_ping'])
+            self.assertEqual(
+                options['connect_args']['options'],
+                '-c statement_timeout=5000'
+            )
+            options = get_engine_options('sqlite://')
+            self.assertNotIn('pool_size', options)
+
+
+# Workers of gthread and gevent serve requests concurrently in one process.
+class SessionScopeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client
+
+    def session_in_context(self):
+        with app.app_context():
+            return db.session()
+
+    def test_session_per_thread(self):
+        sessions = []
+        thread = threading.Thread(
+            target=lambda: sessions.append(self.session_in_context())
+        )
+        thread.start()
+        thread.join()
+        with app.app_context():
+            self.assertIsNot(sessions[0], db.session())
+
+    def test_session_per_greenlet(self):
+        try:
+            import greenlet
+        except ImportError:
+            self.skipTest('greenlet is not installed')
+        with app.app_context():
+            session = db.session()
+            other = greenlet.greenlet(self.session_in_context).switch()
+            self.assertIsNot(other, session)
+            self.assertIs(db.session(), session)
+
+    def test_concurrent_requests(self):
+        results = []
+
+        def get_thread():
+            res = self.client().get('/articles/new-beginnings/comments')
+            results.append((res.status_code, res.data))
+
+        threads = [threading.Thread(target=get_thread) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertEqual({status for status, _ in results}, {200})
+        self.assertEqual(len({data for _, data in results}), 1)
+
+
+# A SQLite file stands in for a replica. It has an article the primary
+# doesn't have, so responses show which database served them.
+class ReplicaRoutingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client
+        self.directory = tempfile.TemporaryDirectory()
+        self.replica = create_engine(
+            f'sqlite:///{self.directory.name}/replica.db'
+        )
+        db.metadata.create_all(self.replica)
+        self.replica.execute(
+            Article.__table__.insert(), id='replica-only', comment_count=0
+        )
+        recent_writers.clear()
+
+    def tearDown(self):
+        replicas.engines = []
+        replicas.down_until.clear()
+        recent_writers.clear()
+        self.replica.dispose()
+        self.directory.cleanup()
+
+    # Ids of articles of GET /articles.
+    def get_articles(self, token=None):
+        headers = {}
+        if token is not None:
+            headers['Authorization'] = f'Bearer {token}'
+        res = self.client().get('/articles', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        return [a['id'] for a in json.loads(res.data)['articles']]
+
+    def test_reads_from_replica(self):
+        self.assertNotIn('replica-only', self.get_articles())
+        replicas.engines = [self.replica]
+        self.assertEqual(self.get_articles(), ['replica-only'])
+
+    def test_reads_own_writes_from_primary(self):
+        user = User.query.get('auth0|5f5dc52e15ab3a00772d41b3')
+        replicas.engines = [self.replica]
+        res = self.client().post('/users', headers={
+                'Authorization': f'Bearer {os.environ["JWT_TEST"]}'
+            },
+            json={
+                'id': user.id,
+                'nickname': user.nickname,
+                'picture': user.picture
+            }
+        )
+        self.assertEqual(res.status_code, 200)
+
+        articles = self.get_articles(os.environ['JWT_TEST'])
+        self.assertNotIn('replica-only', articles)
+        articles = self.get_articles(os.environ['JWT_BARISTA'])
+        self.assertEqual(articles, ['replica-only'])
+        self.assertEqual(self.get_articles(), ['replica-only'])
+
+    # A write and a read served by different workers sharing a store.
+    def test_reads_own_writes_from_other_worker(self):
+        user = User.query.get('auth0|5f5dc52e15ab3a00772d41b3')
+        client = DictClient()
+        replicas.engines = [self.replica]
+        with mock.patch('app.recent_writers', SharedBackend(client)):
+            res = self.client().post('/users', headers={
+                    'Authorization': f'Bearer {os.environ["JWT_TEST"]}'
+                },
+                json={
+                    'id': user.id,
+                    'nickname': user.nickname,
+                    'picture': user.picture
+                }
+            )
+        self.assertEqual(res.status_code, 200)
+
+        with mock.patch('app.recent_writers', SharedBackend(client)):
+            articles = self.get_articles(os.environ['JWT_TEST'])
+            self.assertNotIn('replica-only', articles)
+            articles = self.get_articles(os.environ['JWT_BARISTA'])
+            self.assertEqual(articles, ['replica-only'])
+
+    def test_failover_to_primary(self):
+        down = create_engine(
+            f'sqlite:///{self.directory.name}/missing/replica.db'
+        )
+        replicas.engines = [down, self.replica]
+        self.assertEqual(self.get_articles(), ['replica-only'])
+        self.assertEqual(self.get_articles(), ['replica-only'])
+        self.assertEqual(replicas.stats()['available'], 1)
+
+        replicas.engines = [down]
+        replicas.down_until.clear()
+        self.assertNotIn('replica-only', self.get_articles())
+        res = self.client().get('/health')
+        self.assertEqual(json.loads(res.data)['replicas'], {
+            'replicas': 1,
+            'available': 0
+        })
+
+
+# Tests write more than budgets, so rate limits are disabled in .test.env
+# and enabled here.
+@mock.patch('ratelimit.RATE_LIMITS', True)
+class RateLimitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client
+        limiter.clear()
+
+    def tearDown(self):
+        limiter.clear()
+
+    def edit(self, token, **kwargs):
+        return self.client().patch('/comments/21', headers={
+            'Authorization': f'Bearer {token}'
+        }, json={'content': 'Comment!'}, **kwargs)
+
+    def reply_to_missing(self, token, **kwargs):
+        return self.client().post('/comments/999999', headers={
+            'Authorization': f'Bearer {token}'
+        }, json={'content': 'Reply'}, **kwargs)
+
+    def test_parse_rate(self):
+        self.assertEqual(ratelimit.parse_rate('10/60'), (10, 60.0))
+        self.assertEqual(ratelimit.parse_rate('5'), (5, 1.0))
+        self.assertIsNone(ratelimit.parse_rate('off'))
+        self.assertIsNone(ratelimit.parse_rate(''))
+        with self.assertRaises(ValueError):
+            ratelimit.parse_rate('0/60')
+
+    @mock.patch.object(limiter, 'ip_rate', None)
+    @mock.patch.object(limiter, 'rates', {'edit_comment': (2, 60)})
+    def test_user_budget(self):
+        self.assertEqual(self.edit(os.environ['JWT_BARISTA']).status_code, 200)
+        self.assertEqual(self.edit(os.environ['JWT_BARISTA']).status_code, 200)
+        with StatementLog() as log:
+            res = self.edit(os.environ['JWT_BARISTA'])
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '30')
+        self.assertFalse(json.loads(res.data)['success'])
+        self.assertEqual(log.statements, [])
+
+        # Other users have their own buckets.
+        self.assertEqual(self.edit(os.environ['JWT_MANAGER']).status_code, 403)
+
+    @mock.patch.object(limiter, 'ip_rate', (3, 60))
+    @mock.patch.object(limiter, 'rates', {})
+    def test_address_budget(self):
+        for token in ('JWT_BARISTA', 'JWT_MANAGER', 'JWT_BARISTA'):
+            res = self.reply_to_missing(os.environ[token])
+            self.assertEqual(res.status_code, 404)
+        res = self.reply_to_missing(os.environ['JWT_MANAGER'])
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '20')
+
+        res = self.reply_to_missing(
+            os.environ['JWT_MANAGER'],
+            environ_base={'REMOTE_ADDR': '192.0.2.1'}
+        )
+        self.assertEqual(res.status_code, 404)
+
+    # Requests refused for the address don't spend budgets of users.
+    @mock.patch.object(limiter, 'ip_rate', (1, 60))
+    @mock.patch.object(limiter, 'rates', {'edit_comment': (2, 60)})
+    def test_address_budget_keeps_user_budget(self):
+        self.assertEqual(self.edit(os.environ['JWT_BARISTA']).status_code, 200)
+        for _ in range(3):
+            res = self.edit(os.environ['JWT_BARISTA'])
+            self.assertEqual(res.status_code, 429)
+
+        res = self.edit(
+            os.environ['JWT_BARISTA'],
+            environ_base={'REMOTE_ADDR': '192.0.2.1'}
+        )
+        self.assertEqual(res.status_code, 200)
+
+    @mock.patch.object(limiter, 'rates', {'edit_comment': (1, 60)})
+    def test_disabled(self):
+        with mock.patch('ratelimit.RATE_LIMITS', False):
+            for _ in range(3):
+                res = self.edit(os.environ['JWT_BARISTA'])
+                self.assertEqual(res.status_code, 200)
+
+    def test_refill(self):
+        backend = ratelimit.LocalBackend()
+        key = [('key', (2, 10))]
+        with mock.patch('time.monotonic', return_value=1000.0) as now:
+            self.assertEqual(backend.take(key), (0, None))
+            self.assertEqual(backend.take(key), (0, None))
+            self.assertEqual(backend.take(key), (5, 0))
+            now.return_value = 1005.0
+            self.assertEqual(backend.take(key), (0, None))
+            self.assertEqual(backend.take(key), (5, 0))
+            self.assertEqual(backend.take([('other', (2, 10))]), (0, None))
+
+    # A token is taken from every bucket or none of them.
+    def test_take_all_or_none(self):
+        backend = ratelimit.LocalBackend()
+        buckets = [('user', (2, 60)), ('ip', (1, 60))]
+        with mock.patch('time.monotonic', return_value=1000.0):
+            self.assertEqual(backend.take(buckets), (0, None))
+            self.assertEqual(backend.take(buckets), (60, 1))
+            self.assertEqual(backend.take([('user', (2, 60))]), (0, None))
+
+    def test_bounded_buckets(self):
+        backend = ratelimit.LocalBackend(max_size=2)
+        for key in ('a', 'b', 'c'):
+            backend.take([(key, (1, 60))])
+        self.assertEqual(list(backend.buckets), ['b', 'c'])
+        self.assertEqual(backend.take([('a', (1, 60))]), (0, None))
+
+    # Limiters of workers sharing a store share buckets.
+    def test_shared_backend(self):
+        client = DictClient()
+        workers = [
+            ratelimit.RateLimiter(
+                ratelimit.SharedBackend(client), {'post_reply': (2, 60)}
+            )
+            for _ in range(2)
+        ]
+        with app.test_request_context('/comments/3', method='POST'):
+            self.assertEqual(workers[0].check('post_reply', 'user'), 0)
+            self.assertEqual(workers[1].check('post_reply', 'user'), 0)
+            self.assertGreater(workers[0].check('post_reply', 'user'), 29)
+            self.assertEqual(workers[1].check('post_reply', 'other'), 0)
+
+    @mock.patch('app.MONITORING_ENDPOINTS', True)
+    def test_stats(self):
+        res = self.client().get('/cache/stats')
+        stats = json.loads(res.data)['rate_limits']
+        self.assertEqual(stats['backend'], 'local')
+        self.assertEqual(stats['rates']['post_comment_to_article'], '10/60')
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client
+
+    def test_histogram(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram(
+            'test_seconds', 'Test.', labels=('route',), buckets=(1, 2)
+        )
+        histogram.observe(0.5, '/a')
+        histogram.observe(1.5, '/a')
+        histogram.observe(3, '/a')
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{route="/a",le="1"} 1',
+            'test_seconds_bucket{route="/a",le="2"} 2',
+            'test_seconds_bucket{route="/a",le="+Inf"} 3',
+            'test_seconds_sum{route="/a"} 5.0',
+            'test_seconds_count{route="/a"} 3'
+        ]) + '\n')
+
+    def test_request_metrics(self):
+        labels = ('GET', '/comments/<int:id>')
+
+        def recorded():
+            counts = metrics.request_queries.series.get(labels)
+            return (counts[-1], sum(counts[:-1])) if counts else (0, 0)
+
+        queries, requests = recorded()
+        res = self.client().get('/comments/21')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(recorded(), (queries + 1, requests + 1))
+
+        with mock.patch('app.MONITORING_ENDPOINTS', True):
+            res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(
+            'fcomment_responses_total{method="GET",'
+            'route="/comments/<int:id>",status="200"}',
+            res.get_data(as_text=True)
+        )
+        self.assertIn('fcomment_cache_hits_total', res.get_data(as_text=True))
+
+    def test_monitoring_disabled(self):
+        for url in ('/metrics', '/cache/stats'):
+            res = self.client().get(url)
+            self.assertEqual(res.status_code, 404)
+
+
+class SyntheticDataTestCase(unittest.TestCase):
+    def tearDown(self):
+        with app.app_context():
+            synthetic.clear()
+
+    def generate(self):
+        with app.app_context():
+            counts = synthetic.generate(
+                users=5, articles=4, roots=3, fanout=1.5, max_depth=3,
+                removed=0.5, seed=7
+            )
+            comments = (
+                Comment.query
+                .filter(Comment.article.like(f'{synthetic.PREFIX}-%'))
+                .order_by(Comment.id).all()
+            )
+            shape = [(c.article, c.depth, c.removed) for c in comments]
+            by_id = {c.id: c for c in comments}
+            for c in comments:
+                if c.parent is not None:
+                    parent = by_id[c.parent]
+                    self.assertEqual(c.path, comment_path(c.id, parent.path))
+                    self.assertEqual(c.depth, parent.depth + 1)
+                    self.assertLessEqual(c.depth, 3)
+            for article in Article.query.filter(
+                Article.id.like(f'{synthetic.PREFIX}-%')
+            ):
+                self.assertEqual(article.comment_count, sum(
+                    1 for c in comments
+                    if c.article == article.id and not c.removed
+                ))
+        return counts, shape
+
+    def test_generate_from_seed(self):
+        counts, shape = self.generate()
+        self.assertEqual(counts['comments'], len(shape))
+        self.assertGreater(len(shape), 0)
+        with app.app_context():
+            self.assertEqual(synthetic.clear(), counts)
+        self.assertEqual(self.generate(), (counts, shape))
+
+
+class SerializationTestCase(unittest.TestCase):
+    def test_http_date(self):
+        for value in [datetime.datetime(2020, 9, 9, 16, 20, 28),
+                      datetime.datetime(2021, 1, 3, 4, 5, 6, 789),
+                      utc.localize(datetime.datetime(2020, 2, 29, 23, 0))]:
+            self.assertEqual(
+                http_date(value), werkzeug_http_date(value.utctimetuple())
+            )
+
+    # encode() writes the same JSON as Flask with or without orjson.
+    def test_encode(self):
+        value = {
+            'text': 'ASCII, \x00\x1f\x7f"\\/ \u00e9\u3042\U0001f600',
+            'datetime': datetime.datetime(2020, 9, 9, 16, 20, 28),
+            'nested': [{'b': 1, 'a': None}, True, 12345678901234],
+            'ascii': 'Hello, world!'
+        }
+        with app.app_context():
+            expected = flask_json.dumps(value, separators=(',', ':'))
+            self.assertEqual(encode(value).decode(), expected)
+            with mock.patch('serialization.orjson', None):
+                self.assertEqual(encode(value).decode(), expected)
+
+
+class StreamingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client
+        thread_cache.clear()
+
+    # Streamed responses are the same bytes as built ones.
+    def test_streamed_responses(self):
+        for url in ['/articles', '/users',
+                    '/articles/new-beginnings/comments',
+                    '/articles/new-beginnings/comments?include=users']:
+            thread_cache.clear()
+            built = self.client().get(url)
+            self.assertIn('Content-Length', built.headers)
+
+            thread_cache.clear()
+            with mock.patch('app.STREAM_RESPONSES', True), \
+                    mock.patch('app.STREAM_CHUNK_SIZE', 1):
+                streamed = self.client().get(url)
+            self.assertNotIn('Content-Length', streamed.headers)
+            self.assertEqual(streamed.data, built.data)
+            self.assertEqual(streamed.headers['ETag'], built.headers['ETag'])
+
+    def test_streamed_thread_is_cached(self):
+        url = '/articles/new-beginnings/comments'
+        with mock.patch('app.STREAM_RESPONSES', True):
+            streamed = self.client().get(url).data
+            hits = thread_cache.stats()['hits']
+            res = self.client().get(url)
+        self.assertIn('Content-Length', res.headers)
+        self.assertEqual(res.data, streamed)
+        self.assertEqual(thread_cache.stats()['hits'], hits + 1)
+
+
+# Bodies of the sample data are smaller than the threshold, so it is
+# lowered in these tests.
+@mock.patch('compression.COMPRESS_MIN_SIZE', 100)
+class CompressionTestCase(unittest.TestCase):
+    URL = '/articles/new-beginnings/comments'
+
+    def setUp(self):
+        self.client = app.test_client
+        thread_cache.clear()
+
+    def test_gzip(self):
+        identity = self.client().get(self.URL)
+        res = self.client().get(self.URL, headers={
+            'Accept-Encoding': 'gzip'
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(
+            res.headers['ETag'], identity.headers['ETag'][:-1] + '-gzip"'
+        )
+        self.assertEqual(
+            compression.decompress(res.data, 'gzip'), identity.data
+        )
+        self.assertLess(len(res.data), len(identity.data))
+
+    def test_brotli(self):
+        if compression.brotli is None:
+            self.skipTest('brotli is not installed')
+        res = self.client().get(self.URL, headers={
+            'Accept-Encoding': 'gzip, br'
+        })
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        body = json.loads(compression.decompress(res.data, 'br'))
+        self.assertTrue(body['success'])
+
+    def test_small_or_not_accepted(self):
+        res = self.client().get(self.URL)
+        self.assertNotIn('Content-Encoding', res.headers)
+        res = self.client().get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        res = self.client().get(self.URL, headers={
+            'Accept-Encoding': 'gzip;q=0'
+        })
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_compressed_not_modified(self):
+        headers = {'Accept-Encoding': 'gzip'}
+        res = self.client().get(self.URL, headers=headers)
+        res = self.client().get(self.URL, headers={
+            **headers, 'If-None-Match': res.headers['ETag']
+        })
+        self.assertEqual(res.status_code, 304)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+    def test_identity_not_modified(self):
+        res = self.client().get(
+            self.URL, headers={'Accept-Encoding': 'gzip'}
+        )
+        etag = res.headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        res = self.client().get(self.URL, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        plain = res.headers['ETag']
+        res = self.client().get(self.URL, headers={'If-None-Match': plain})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], plain)
+
+    def test_cached_thread_compressed_once(self):
+        headers = {'Accept-Encoding': 'gzip'}
+        with mock.patch(
+            'compression.compress', wraps=compression.compress
+        ) as compress:
+            first = self.client().get(self.URL, headers=headers)
+            second = self.client().get(self.URL, headers=headers)
+        self.assertEqual(compress.call_count, 1)
+        self.assertEqual(first.data, second.data)
+
+    def test_other_responses(self):
+        res = self.client().get('/users', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        users = json.loads(compression.decompress(res.data, 'gzip'))['users']
+        self.assertEqual(len(users), 3)
+
+
+class CompactShapeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client
+        thread_cache.clear()
+
+    def assertCompact(self, comments, nested=False):
+        for comment in comments:
+            if nested:
+                self.assertNotIn('article', comment)
+                self.assertNotIn('parent', comment)
+            else:
+                self.assertIn('article', comment)
+                self.assertIn('parent', comment)
+            self.assertCompact(comment.get('replies', []), nested=True)
+
+    def test_thread(self):
+        res = self.client().get(
+            '/articles/new-beginnings/comments?shape=compact'
+        )
+        full = self.client().get('/articles/new-beginnings/comments')
+        comments = json.loads(res.data)['comments']
+        self.assertCompact(comments)
+        self.assertEqual(comments[0]['replies'][0]['id'], 15)
+        self.assertLess(len(res.data), len(full.data))
+
+    def test_thread_page_and_replies(self):
+        res = self.client().get(
+            '/articles/new-beginnings/comments?shape=compact&per_page=1'
+        )
+        self.assertCompact(json.loads(res.data)['comments'])
+        res = self.client().get('/comments/3/replies?shape=compact')
+        comments = json.loads(res.data)['comments']
+        self.assertEqual(comments[0]['parent'], 3)
+        self.assertCompact(comments)
+
+    def test_streamed_thread(self):
+        with mock.patch('app.STREAM_RESPONSES', True):
+            res = self.client().get(
+                '/articles/new-beginnings/comments?shape=compact'
+            )
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertCompact(json.loads(res.data)['comments'])
+
+
+class ETagTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client
+
+    def test_thread_not_modified(self):
+        res = self.client().get('/articles/new-beginnings/comments')
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('public', res.headers['Cache-Control'])
+
+        with StatementLog() as log:
+            res = self.client().get(
+                '/articles/new-beginnings/comments',
+                headers={'If-None-Match': etag}
+            )
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(log.on_table('comments'), [])
+
+    def test_thread_modified(self):
+        res = self.client().get('/articles/hello-world/comments')
+        etag = res.headers['ETag']
+
+        res = self.client().post('articles/hello-world/comments', headers={
+                'Authorization': f'Bearer {os.environ["JWT_BARISTA"]}'
+            },
+            json={
+                'content': 'Test comment for ETag'
+            }
+        )
+        comment_id = json.loads(res.data)['id']
+        res = self.client().get(
+            '/articles/hello-world/comments',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+        self.client().delete(f'comments/{comment_id}', headers={
+                'Authorization': f'Bearer {os.environ["JWT_BARISTA"]}'
+            }
+        )
+
+    def test_tables_not_modified(self):
+        for url, table in [('/users', 'users'), ('/articles', 'articles')]:
+            res = self.client().get(url)
+            with StatementLog() as log:
+                res = self.client().get(
+                    url, headers={'If-None-Match': res.headers['ETag']}
+                )
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(log.on_table(table), [])
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.file = tempfile.NamedTemporaryFile(
+            mode='w', suffix='.json', delete=False
+        )
+        self.file.close()
+        self.write_keys('key-1')
+        self.store = JWKSKeyStore(
+            f'file://{self.file.name}', ttl=600, min_refresh_interval=30
+        )
+
+    def tearDown(self):
+        if os.path.exists(self.file.name):
+            os.remove(self.file.name)
+
+    def write_keys(self, *kids):
+        with open(self.file.name, 'w') as f:
+            json.dump({'keys': [{
+                'kty': 'RSA',
+                'kid': kid,
+                'use': 'sig',
+                'n': f'n-{kid}',
+                'e': 'AQAB'
+            } for kid in kids]}, f)
+
+    def test_get_key_from_cache(self):
+        self.assertTrue(self.store.warm())
+        os.remove(self.file.name)
+        self.assertEqual(self.store.get_key('key-1')['n'], 'n-key-1')
+
+    def test_refresh_on_unknown_kid(self):
+        self.store.min_refresh_interval = 0
+        self.store.warm()
+        self.write_keys('key-1', 'key-2')
+        self.assertEqual(self.store.get_key('key-2')['n'], 'n-key-2')
+
+    def test_rate_limit_refresh_on_unknown_kid(self):
+        self.store.warm()
+        self.assertIsNone(self.store.get_key('key-2'))
+        # Refresh is not attempted again within the interval.
+        self.write_keys('key-1', 'key-2')
+        self.assertIsNone(self.store.get_key('key-2'))
+
+    def test_serve_stale_keys_on_failure(self):
+        self.store.ttl = 0
+        self.store.min_refresh_interval = 0
+        self.store.warm()
+        os.remove(self.file.name)
+        self.assertEqual(self.store.get_key('key-1')['n'], 'n-key-1')
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        verified_tokens.clear()
+
+    def tearDown(self):
+        verified_tokens.clear()
+
+    def cache_token(self, token, exp):
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
+        verified_tokens.set(token_hash, {'sub': 'cached', 'exp': exp})
+
+    def test_lru_eviction_and_counters(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_cached_token_skips_verification(self):
+        self.cache_token('not-a-jwt', time.time() + 60)
+        payload = verify_decode_jwt('not-a-jwt')
+        self.assertEqual(payload['sub'], 'cached')
+
+    def test_cached_token_expired(self):
+        self.cache_token('not-a-jwt', time.time() - 60)
+        with self.assertRaises(AuthError) as context:
+            verify_decode_jwt('not-a-jwt')
+        self.assertEqual(context.exception.status_code, 401)
+        self.assertEqual(context.exception.error['code'], 'token_expired')
+
 
 if __name__ == '__main__':
     unittest.main()